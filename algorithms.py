@@ -2,6 +2,133 @@ from operator import *
 from functools import *
 
 
+class TreeDef(object):
+    '''
+    structure of nested sequence (like tf.nest / jax pytrees).
+    computed once by tree_flatten and reused to flatten, unflatten, map and zip
+    sequences of the same structure in linear time without isinstance checks.
+    leaf is represented as TreeDef without children
+    '''
+
+    __slots__ = ("node_type", "children")
+
+    def __init__(self, node_type=None, children=None):
+
+        self.node_type = node_type
+        self.children = children
+
+    def __eq__(self, other):
+
+        return isinstance(other, TreeDef) and self.node_type == other.node_type and self.children == other.children
+
+    def __ne__(self, other):
+
+        return not self == other
+
+    def __repr__(self):
+
+        return "*" if self.children is None else "{}({})".format(self.node_type.__name__, ", ".join(map(repr, self.children)))
+
+    @property
+    def num_leaves(self):
+
+        return 1 if self.children is None else sum(child.num_leaves for child in self.children)
+
+    @property
+    def paths(self):
+        '''
+        list of index tuples of leaves
+        '''
+
+        if self.children is None:
+            return [()]
+
+        return [(index,) + path for index, child in enumerate(self.children) for path in child.paths]
+
+    def flatten(self, sequence):
+
+        leaves = []
+        self._flatten(sequence, leaves)
+        return leaves
+
+    def _flatten(self, sequence, leaves):
+
+        if self.children is None:
+            leaves.append(sequence)
+            return
+
+        if len(sequence) != len(self.children):
+            raise ValueError("sequence doesn't match structure {}".format(self))
+
+        for child, element in zip(self.children, sequence):
+            child._flatten(element, leaves)
+
+    def unflatten(self, leaves):
+
+        return self._unflatten(iter(leaves))
+
+    def _unflatten(self, leaves):
+
+        if self.children is None:
+            return next(leaves)
+
+        elements = [child._unflatten(leaves) for child in self.children]
+        return elements if self.node_type is list else self.node_type(elements)
+
+    def map(self, function, *sequences):
+
+        if len(sequences) == 1:
+            return self._map(function, sequences[0])
+
+        return self.unflatten(map(function, *map(self.flatten, sequences)))
+
+    def _map(self, function, sequence):
+
+        if self.children is None:
+            return function(sequence)
+
+        if len(sequence) != len(self.children):
+            raise ValueError("sequence doesn't match structure {}".format(self))
+
+        elements = [child._map(function, element) for child, element in zip(self.children, sequence)]
+        return elements if self.node_type is list else self.node_type(elements)
+
+    def zip(self, *sequences):
+
+        return self.unflatten(zip(*map(self.flatten, sequences)))
+
+    def enumerate(self, sequence):
+
+        return self.unflatten(zip(self.paths, self.flatten(sequence)))
+
+
+def tree_flatten(sequence, classes=(list,), innermost_list=False):
+    '''
+    return tuple of flattened leaves and TreeDef.
+    leaf is innermost element (default) or innermost list (innermost_list=True)
+    '''
+
+    leaves = []
+    return leaves, _tree_flatten(sequence, classes, innermost_list, leaves)
+
+
+def _tree_flatten(sequence, classes, innermost_list, leaves):
+
+    if isinstance(sequence, classes) and (not innermost_list or any(isinstance(element, classes) for element in sequence)):
+        return TreeDef(type(sequence), [_tree_flatten(element, classes, innermost_list, leaves) for element in sequence])
+
+    leaves.append(sequence)
+    return LEAF
+
+
+LEAF = TreeDef()
+
+
+def tree_structure(sequence, classes=(list,), innermost_list=False):
+
+    return tree_flatten(sequence, classes, innermost_list)[1]
+
+
 def compose(function, *functions):
     '''
     conpose functions from left to right
@@ -16,8 +143,8 @@ def map_innermost_element(function, sequence, classes=(list,)):
     innermost element is defined as element which is not instance of "classes" (default: list)
     '''
 
-    return (type(sequence)(map(lambda element: map_innermost_element(function, element, classes=classes), sequence))
-            if isinstance(sequence, classes) else function(sequence))
+    leaves, treedef = tree_flatten(sequence, classes)
+    return treedef.unflatten(map(function, leaves))
 
 
 def map_innermost_list(function, sequence, classes=(list,)):
@@ -26,8 +153,8 @@ def map_innermost_list(function, sequence, classes=(list,)):
     innermost list is defined as list which doesn't contain instance of "classes" (default: list)
     '''
 
-    return (type(sequence)(map(lambda element: map_innermost_list(function, element, classes=classes), sequence))
-            if isinstance(sequence, classes) and any(map(lambda element: isinstance(element, classes), sequence)) else function(sequence))
+    leaves, treedef = tree_flatten(sequence, classes, innermost_list=True)
+    return treedef.unflatten(map(function, leaves))
 
 
 def enumerate_innermost_element(sequence, classes=(list,), indices=()):
@@ -36,8 +163,8 @@ def enumerate_innermost_element(sequence, classes=(list,), indices=()):
     innermost element is defined as element which is not instance of "classes" (default: list)
     '''
 
-    return (type(sequence)(map(lambda index_element: enumerate_innermost_element(index_element[1], classes=classes, indices=indices + (index_element[0],)), enumerate(sequence)))
-            if isinstance(sequence, classes) else (indices, sequence))
+    leaves, treedef = tree_flatten(sequence, classes)
+    return treedef.unflatten(zip((indices + path for path in treedef.paths), leaves))
 
 
 def enumerate_innermost_list(sequence, classes=(list,), indices=()):
@@ -46,8 +173,8 @@ def enumerate_innermost_list(sequence, classes=(list,), indices=()):
     innermost list is defined as list which doesn't contain instance of "classes" (default: list)
     '''
 
-    return (type(sequence)(map(lambda index_element: enumerate_innermost_list(index_element[1], classes=classes, indices=indices + (index_element[0],)), enumerate(sequence)))
-            if isinstance(sequence, classes) and any(map(lambda element: isinstance(element, classes), sequence)) else (indices, sequence))
+    leaves, treedef = tree_flatten(sequence, classes, innermost_list=True)
+    return treedef.unflatten(zip((indices + path for path in treedef.paths), leaves))
 
 
 def zip_innermost_element(*sequences, classes=(list,)):
@@ -56,6 +183,11 @@ def zip_innermost_element(*sequences, classes=(list,)):
     innermost element is defined as element which is not instance of "classes" (default: list)
     '''
 
+    flattened = [tree_flatten(sequence, classes) for sequence in sequences]
+    if flattened and all(treedef == flattened[0][1] for _, treedef in flattened):
+        return flattened[0][1].unflatten(zip(*(leaves for leaves, _ in flattened)))
+
+    # 構造が一致しない場合は短い方に合わせる
     return (list(map(lambda elements: zip_innermost_element(*elements, classes=classes), zip(*sequences)))
             if all(map(lambda sequence: isinstance(sequence, classes), sequences)) else sequences)
 
@@ -66,6 +198,11 @@ def zip_innermost_list(*sequences, classes=(list,)):
     innermost list is defined as list which doesn't contain instance of "classes" (default: list)
     '''
 
+    flattened = [tree_flatten(sequence, classes, innermost_list=True) for sequence in sequences]
+    if flattened and all(treedef == flattened[0][1] for _, treedef in flattened):
+        return flattened[0][1].unflatten(zip(*(leaves for leaves, _ in flattened)))
+
+    # 構造が一致しない場合は短い方に合わせる
     return (list(map(lambda elements: zip_innermost_list(*elements, classes=classes), zip(*sequences)))
             if all(map(lambda sequence: isinstance(sequence, classes) and any(map(lambda element: isinstance(element, classes), sequence)), sequences)) else sequences)
 
@@ -76,8 +213,7 @@ def flatten_innermost_element(sequence, classes=(list,)):
     innermost element is defined as element which is not instance of "classes" (default: list)
     '''
 
-    return (reduce(add, map(lambda element: flatten_innermost_element(element, classes=classes), sequence), [])
-            if isinstance(sequence, classes) else [sequence])
+    return tree_flatten(sequence, classes)[0]
 
 
 def flatten_innermost_list(sequence, classes=(list,)):
@@ -86,5 +222,4 @@ def flatten_innermost_list(sequence, classes=(list,)):
     innermost list is defined as list which doesn't contain instance of "classes" (default: list)
     '''
 
-    return (reduce(add, map(lambda element: flatten_innermost_list(element, classes=classes), sequence))
-            if isinstance(sequence, classes) and any(map(lambda element: isinstance(element, classes), sequence)) else [sequence])
+    return tree_flatten(sequence, classes, innermost_list=True)[0]
@@ -0,0 +1,103 @@
+import argparse
+import timeit
+import algorithms
+from operator import *
+from functools import *
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--number", type=int, default=100, help="number of executions per measurement")
+
+
+# =========================================================================================
+# recursive implementations previously used by algorithms.py (reference implementations)
+
+def map_innermost_element(function, sequence, classes=(list,)):
+
+    return (type(sequence)(map(lambda element: map_innermost_element(function, element, classes=classes), sequence))
+            if isinstance(sequence, classes) else function(sequence))
+
+
+def map_innermost_list(function, sequence, classes=(list,)):
+
+    return (type(sequence)(map(lambda element: map_innermost_list(function, element, classes=classes), sequence))
+            if isinstance(sequence, classes) and any(map(lambda element: isinstance(element, classes), sequence)) else function(sequence))
+
+
+def enumerate_innermost_element(sequence, classes=(list,), indices=()):
+
+    return (type(sequence)(map(lambda index_element: enumerate_innermost_element(index_element[1], classes=classes, indices=indices + (index_element[0],)), enumerate(sequence)))
+            if isinstance(sequence, classes) else (indices, sequence))
+
+
+def zip_innermost_element(*sequences, classes=(list,)):
+
+    return (list(map(lambda elements: zip_innermost_element(*elements, classes=classes), zip(*sequences)))
+            if all(map(lambda sequence: isinstance(sequence, classes), sequences)) else sequences)
+
+
+def flatten_innermost_element(sequence, classes=(list,)):
+
+    return (reduce(add, map(lambda element: flatten_innermost_element(element, classes=classes), sequence), [])
+            if isinstance(sequence, classes) else [sequence])
+
+
+def flatten_innermost_list(sequence, classes=(list,)):
+
+    return (reduce(add, map(lambda element: flatten_innermost_list(element, classes=classes), sequence))
+            if isinstance(sequence, classes) and any(map(lambda element: isinstance(element, classes), sequence)) else [sequence])
+
+# =========================================================================================
+
+
+def nested(shape, leaf=0):
+    '''
+    make nested list of given shape whose leaves are consecutive integers
+    '''
+
+    if not shape:
+        return leaf
+
+    size = reduce(mul, shape[1:], 1)
+    return [nested(shape[1:], leaf + i * size) for i in range(shape[0])]
+
+
+def benchmark(name, sequence, number):
+
+    leaves, treedef = algorithms.tree_flatten(sequence)
+
+    # 従来の実装と結果が一致することを確認
+    assert algorithms.flatten_innermost_element(sequence) == flatten_innermost_element(sequence)
+    assert algorithms.flatten_innermost_list(sequence) == flatten_innermost_list(sequence)
+    assert algorithms.map_innermost_element(str, sequence) == map_innermost_element(str, sequence)
+    assert algorithms.map_innermost_list(len, sequence) == map_innermost_list(len, sequence)
+    assert algorithms.enumerate_innermost_element(sequence) == enumerate_innermost_element(sequence)
+    assert algorithms.zip_innermost_element(sequence, sequence) == zip_innermost_element(sequence, sequence)
+
+    cases = [
+        ("flatten", lambda: flatten_innermost_element(sequence), lambda: algorithms.flatten_innermost_element(sequence), lambda: treedef.flatten(sequence)),
+        ("unflatten", lambda: map_innermost_element(lambda leaf: leaf, sequence), lambda: algorithms.map_innermost_element(lambda leaf: leaf, sequence), lambda: treedef.unflatten(leaves)),
+        ("map", lambda: map_innermost_element(str, sequence), lambda: algorithms.map_innermost_element(str, sequence), lambda: treedef.map(str, sequence)),
+        ("zip", lambda: zip_innermost_element(sequence, sequence), lambda: algorithms.zip_innermost_element(sequence, sequence), lambda: treedef.zip(sequence, sequence)),
+    ]
+
+    print("{}: {} leaves".format(name, treedef.num_leaves))
+
+    for operation, reference, wrapper, cached in cases:
+        print("    {:<10} reference: {:.3e} sec, wrapper: {:.3e} sec, cached treedef: {:.3e} sec".format(
+            operation,
+            timeit.timeit(reference, number=number) / number,
+            timeit.timeit(wrapper, number=number) / number,
+            timeit.timeit(cached, number=number) / number
+        ))
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    # multi_synth90k_main.py: 5 words x 11 characters
+    benchmark("multi_synth90k [5, 11]", nested([5, 11]), args.number)
+    # deep: binary tree of depth 12
+    benchmark("deep [2] * 12", nested([2] * 12), args.number)
+    # wide: 10000 leaves in a single list
+    benchmark("wide [10000]", nested([10000]), args.number)
@@ -0,0 +1,107 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+from attrdict import AttrDict as Param
+from networks.attention_network import AttentionNetwork
+from algorithms import *
+from benchmark_utils import measure, moving_statistics
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=100, help="batch size")
+parser.add_argument("--feature_shape", type=int, nargs=3, default=[64, 32, 32], help="shape of input feature maps [C, H, W]")
+parser.add_argument("--data_format", type=str, default="channels_first", help="data format")
+parser.add_argument("--number", type=int, default=10, help="number of measured runs")
+parser.add_argument("--random_seed", type=int, default=1209, help="random seed")
+
+# synth90k_main.py, multi_synth90k_main.pyのattention network
+settings = dict(
+    synth90k=[Param(sequence_length=24, num_units=256)],
+    multi_synth90k=[Param(sequence_length=5, num_units=256), Param(sequence_length=11, num_units=256)],
+)
+
+# 比較する計算方法 (出力は全て同じ)
+options = [
+    ("reference", dict()),
+    ("batched_levels", dict(batched_levels=True)),
+    ("batched_deconv", dict(batched_deconv=True)),
+    ("all", dict(hoisted_lstm=True, batched_levels=True, batched_deconv=True)),
+]
+
+
+def attention_network(rnn_params, data_format, **kwargs):
+
+    return AttentionNetwork(
+        conv_params=[
+            Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
+            Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
+        ],
+        rnn_params=rnn_params,
+        deconv_params=[
+            Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
+            Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
+        ],
+        data_format=data_format,
+        **kwargs
+    )
+
+
+def benchmark(name, rnn_params, args):
+
+    print("{}: {}".format(name, [rnn_param.sequence_length for rnn_param in rnn_params]))
+
+    for training in [True, False]:
+
+        with tf.Graph().as_default():
+
+            feature_shape = args.feature_shape if args.data_format == "channels_first" else args.feature_shape[1:] + args.feature_shape[:1]
+            inputs = tf.constant(np.random.uniform(size=[args.batch_size] + feature_shape), dtype=tf.float32)
+
+            # 全ての計算方法で変数を共有する
+            results = []
+            for option, kwargs in options:
+                num_update_ops = len(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+                attention_maps = tf.stack(flatten_innermost_element(attention_network(rnn_params, args.data_format, **kwargs)(
+                    inputs=inputs,
+                    training=training,
+                    reuse=tf.AUTO_REUSE
+                )), axis=1)
+                gradients = tf.gradients(tf.reduce_sum(attention_maps), tf.trainable_variables())
+                update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)[num_update_ops:]
+                results.append((option, attention_maps, gradients, update_ops))
+
+            moving_variables = [variable for variable in tf.global_variables() if "moving_" in variable.name]
+
+            with tf.Session() as session:
+
+                session.run(tf.global_variables_initializer())
+
+                # batch normalizationは位置ごとの統計量を使うので，trainingでもreferenceと一致する
+                # 移動統計はreferenceの各位置の更新を順に適用したものと一致する
+                reference_attention_maps, reference_gradients = session.run(results[0][1:3])
+                reference_moving_statistics = moving_statistics(session, results[0][3], moving_variables)
+                for option, attention_maps, gradients, update_ops in results[1:]:
+                    attention_maps, gradients = session.run([attention_maps, gradients])
+                    assert np.allclose(attention_maps, reference_attention_maps, atol=1e-5), option
+                    for gradient, reference_gradient in zip(gradients, reference_gradients):
+                        assert np.allclose(gradient, reference_gradient, rtol=1e-3, atol=1e-4), option
+                    for statistics, reference_statistics in zip(moving_statistics(session, update_ops, moving_variables), reference_moving_statistics):
+                        assert np.allclose(statistics, reference_statistics, rtol=1e-4, atol=1e-6), option
+
+                for option, attention_maps, gradients, update_ops in results:
+                    print("    {:<16} training={:<6} forward: {:.3e} sec, forward + backward: {:.3e} sec".format(
+                        option,
+                        str(training),
+                        measure(session, attention_maps, args.number),
+                        measure(session, [attention_maps, gradients], args.number)
+                    ))
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    np.random.seed(args.random_seed)
+    tf.set_random_seed(args.random_seed)
+
+    for name, rnn_params in settings.items():
+        benchmark(name, rnn_params, args)
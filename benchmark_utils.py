@@ -0,0 +1,29 @@
+import tensorflow as tf
+import time
+
+
+def measure(session, fetches, number):
+    '''
+    return mean seconds of session.run(fetches) over number runs after a warmup run
+    '''
+
+    session.run(fetches)
+
+    begin = time.time()
+    for _ in range(number):
+        session.run(fetches)
+
+    return (time.time() - begin) / number
+
+
+def moving_statistics(session, update_ops, moving_variables):
+    '''
+    moving statistics after running update_ops one by one in order from the initial values.
+    used to check batched batch normalization against the reference per-element updates
+    '''
+
+    session.run(tf.variables_initializer(moving_variables))
+    for update_op in update_ops:
+        session.run(update_op)
+
+    return session.run(moving_variables)
@@ -14,8 +14,8 @@ import tensorflow as tf
 import argparse
 import functools
 import dataset
-from models.hats import HATS
-from networks.attention_network import AttentionNetwork
+from convert_dataset import class_ids
+from models.classifier import Classifier
 from networks.pyramid_resnet import PyramidResNet
 from attrdict import AttrDict as Param
 
@@ -32,6 +32,11 @@ parser.add_argument("--max_steps", type=int, default=10000, help="maximum number
 parser.add_argument("--steps", type=int, default=None, help="number of evaluation steps")
 parser.add_argument('--train', action="store_true", help="with training")
 parser.add_argument('--eval', action="store_true", help="with evaluation")
+parser.add_argument('--keep_uint8', action="store_true", help="keep images uint8 in input pipeline")
+parser.add_argument("--pipeline_config", type=str, default=None, help="input pipeline config written by dataset_benchmark.py")
+parser.add_argument('--export', action="store_true", help="export SavedModel for serving")
+parser.add_argument('--export_numeric', action="store_true", help="export with uint8 image input and class id outputs (for quantize_model.py)")
+parser.add_argument("--export_dir", type=str, default="chars74k_classifier_export", help="base directory of exported SavedModels")
 parser.add_argument("--gpu", type=str, default="0", help="gpu id")
 args = parser.parse_args()
 
@@ -56,8 +61,12 @@ if __name__ == "__main__":
             num_classes=37,
             data_format=args.data_format,
             hyper_params=Param(
-                optimizer=tf.train.AdamOptimizer()
-            )
+                learning_rate=1e-3,
+                beta1=0.9,
+                beta2=0.999
+            ),
+            class_names=sorted(class_ids, key=class_ids.get),
+            prediction_outputs=["predictions"] if args.export_numeric else ["predictions", "strings"]
         )(features, labels, mode),
         model_dir=args.model_dir,
         config=tf.estimator.RunConfig(
@@ -89,7 +98,9 @@ if __name__ == "__main__":
                 sequence_lengths=[],
                 encoding="png",
                 image_size=[128, 128],
-                data_format=args.data_format
+                data_format=args.data_format,
+                keep_uint8=args.keep_uint8,
+                pipeline_config=args.pipeline_config
             ),
             max_steps=args.max_steps
         )
@@ -106,7 +117,26 @@ if __name__ == "__main__":
                 sequence_lengths=[],
                 encoding="png",
                 image_size=[128, 128],
-                data_format=args.data_format
+                data_format=args.data_format,
+                keep_uint8=args.keep_uint8,
+                pipeline_config=args.pipeline_config
             ),
             steps=args.steps
         ))
+
+    if args.export:
+
+        # 画像のdecodeとresizeを含むserving用のgraph (prediction modeのみ)
+        export_dir = estimator.export_saved_model(
+            export_dir_base=args.export_dir,
+            serving_input_receiver_fn=functools.partial(
+                dataset.image_serving_input_receiver_fn,
+                image_size=[128, 128]
+            ) if args.export_numeric else functools.partial(
+                dataset.serving_input_receiver_fn,
+                encoding="png",
+                image_size=[128, 128]
+            )
+        )
+
+        print("SavedModel exported to {}".format(export_dir.decode("utf-8")))
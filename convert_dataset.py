@@ -2,23 +2,74 @@ import tensorflow as tf
 import numpy as np
 import skimage
 import argparse
-import sys
+import multiprocessing
+import functools
+import itertools
+import sqlite3
+import zlib
 import os
 from tqdm import *
-from algorithms import *
+import dataset
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input_filename", type=str, help="input ground truth filename")
 parser.add_argument("--output_filename", type=str, help="output tfrecord filename")
 parser.add_argument("--num_words", type=int, help="number of words contained in a instance (include eos)")
 parser.add_argument("--num_chars", type=int, help="number of characters contained in a instance (include eos)")
-args = parser.parse_args()
+parser.add_argument("--embed_images", action="store_true", help="store encoded image bytes instead of only file paths")
+parser.add_argument("--num_shards", type=int, default=1, help="number of output tfrecord shards")
+parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="number of converter processes")
+parser.add_argument("--validation", type=str, default="header", choices=["header", "decode"], help="image validation mode")
+parser.add_argument("--validation_cache", type=str, default=None, help="validation cache filename (default: <input_filename>.validation.db)")
 
+class_ids = {}
+class_ids.update({chr(j): i for i, j in enumerate(range(ord("0"), ord("9") + 1), 0)})
+class_ids.update({chr(j): i for i, j in enumerate(range(ord("A"), ord("Z") + 1), class_ids["9"] + 1)})
+class_ids.update({"": max(class_ids.values()) + 1})
 
-def pad(sequence, sequence_length, value):
-    while len(sequence) < sequence_length:
-        sequence.append(value)
-    return sequence
+# code point => class id のlookup table (未知の文字は-1)
+class_table = np.full(max(map(ord, "".join(class_ids) + "".join(class_ids).lower())) + 1, -1, dtype=np.int64)
+for char, class_id in class_ids.items():
+    if char:
+        class_table[ord(char)] = class_id
+        class_table[ord(char.lower())] = class_id
+
+# 全プロセスで共有する進捗カウンタ (init_workerで設定される)
+counter = None
+# validation用プロセスごとのcacheへのconnection (init_validatorで設定される)
+cache = None
+
+
+def encode_labels(strings, num_words, num_chars):
+    '''
+    encode "word1_word2_..." strings to labels of shape [len(strings), num_words, num_chars].
+    labels are padded with blank (class_ids[""]) and letters are case-insensitive
+    '''
+
+    words = [string.split("_") for string in strings]
+    word_counts = np.array(list(map(len, words)), dtype=np.int64)
+    words = list(itertools.chain.from_iterable(words))
+    word_lengths = np.array(list(map(len, words)), dtype=np.int64)
+
+    if np.any(word_counts > num_words) or np.any(word_lengths > num_chars):
+        raise ValueError("label exceeds [num_words, num_chars] = [{}, {}]".format(num_words, num_chars))
+
+    chars = np.frombuffer("".join(words).encode("utf-32-le"), dtype=np.uint32)
+    if np.any(chars >= len(class_table)):
+        raise ValueError("label contains unknown characters")
+    chars = class_table[chars]
+    if np.any(chars < 0):
+        raise ValueError("label contains unknown characters")
+
+    # 各文字の(行, 単語, 文字)位置を求めて一度にscatterする
+    string_indices = np.repeat(np.arange(len(word_counts)), word_counts)
+    word_indices = np.arange(len(word_lengths)) - np.repeat(np.cumsum(word_counts) - word_counts, word_counts)
+    char_indices = np.arange(len(chars)) - np.repeat(np.cumsum(word_lengths) - word_lengths, word_lengths)
+
+    labels = np.full([len(word_counts), num_words, num_chars], class_ids[""], dtype=np.int64)
+    labels[np.repeat(string_indices, word_lengths), np.repeat(word_indices, word_lengths), char_indices] = chars
+
+    return labels
 
 
 def invalid(path):
@@ -29,54 +80,283 @@ def invalid(path):
     return False
 
 
-def main(input_filename, output_filename, num_words, num_chars):
+def valid_jpeg(data):
+    '''
+    walk jpeg markers until start of scan and check that image ends with EOI.
+    entropy-coded data is not decoded
+    '''
+
+    if data[:2] != b"\xff\xd8":
+        return False
+
+    i = 2
+    frame = False
+
+    while i + 4 <= len(data):
+        if data[i] != 0xff:
+            return False
+        marker = data[i + 1]
+        # fill byte
+        if marker == 0xff:
+            i += 1
+            continue
+        # standalone markers (TEM, RSTn)
+        if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            i += 2
+            continue
+        # EOI before SOS
+        if marker == 0xd9:
+            return False
+        length = int.from_bytes(data[i + 2:i + 4], "big")
+        if length < 2:
+            return False
+        # SOFn (DHT, JPG, DAC are not frame headers)
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            frame = True
+        # SOS: "\xff\xd9" can't appear in entropy-coded data because 0xff is stuffed
+        if marker == 0xda:
+            return frame and data.find(b"\xff\xd9", i + 2 + length) != -1
+        i += 2 + length
+
+    return False
+
+
+def valid_png(data):
+    '''
+    walk png chunks from IHDR to IEND and check their CRCs.
+    image data is not inflated
+    '''
+
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        return False
+
+    i = 8
+
+    while i + 12 <= len(data):
+        length = int.from_bytes(data[i:i + 4], "big")
+        chunk_type = data[i + 4:i + 8]
+        if i == 8 and chunk_type != b"IHDR":
+            return False
+        end = i + 12 + length
+        if end > len(data):
+            return False
+        if zlib.crc32(data[i + 4:i + 8 + length]) != int.from_bytes(data[i + 8 + length:end], "big"):
+            return False
+        if chunk_type == b"IEND":
+            return True
+        i = end
+
+    return False
+
+
+def valid_header(path):
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    return valid_jpeg(data) if data[:2] == b"\xff\xd8" else valid_png(data)
+
+
+def init_validator(cache_filename):
+
+    global cache
+    cache = sqlite3.connect(cache_filename)
+
+
+def validate(path, mode):
+    '''
+    return (path, size, mtime, valid, cached).
+    result is looked up in cache by (path, size, mtime) before checking the image
+    '''
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None, None, False, False
+
+    row = cache.execute(
+        "SELECT valid FROM validation WHERE path = ? AND mode = ? AND size = ? AND mtime = ?",
+        (path, mode, stat.st_size, stat.st_mtime)
+    ).fetchone()
+
+    if row:
+        return path, stat.st_size, stat.st_mtime, bool(row[0]), True
+
+    try:
+        valid = valid_header(path) if mode == "header" else not invalid(path)
+    except OSError:
+        valid = False
+
+    return path, stat.st_size, stat.st_mtime, valid, False
+
 
-    class_ids = {}
-    class_ids.update({chr(j): i for i, j in enumerate(range(ord("0"), ord("9") + 1), 0)})
-    class_ids.update({chr(j): i for i, j in enumerate(range(ord("A"), ord("Z") + 1), class_ids["9"] + 1)})
-    class_ids.update({"": max(class_ids.values()) + 1})
+def find_invalid(paths, mode, cache_filename, num_processes):
+    '''
+    return set of invalid paths.
+    only images which are new or modified since last run are checked
+    '''
+
+    with sqlite3.connect(cache_filename) as connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS validation "
+            "(path TEXT, mode TEXT, size INTEGER, mtime REAL, valid INTEGER, PRIMARY KEY (path, mode))"
+        )
+
+    invalid_paths = set()
+    results = []
+
+    with multiprocessing.Pool(
+        processes=num_processes,
+        initializer=init_validator,
+        initargs=(cache_filename,)
+    ) as pool:
+
+        for path, size, mtime, valid, cached in tqdm(pool.imap(
+            func=functools.partial(validate, mode=mode),
+            iterable=paths,
+            chunksize=1000
+        ), total=len(paths)):
+
+            if not valid:
+                invalid_paths.add(path)
+            if not cached and size is not None:
+                results.append((path, mode, size, mtime, int(valid)))
+
+    with sqlite3.connect(cache_filename) as connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO validation VALUES (?, ?, ?, ?, ?)",
+            results
+        )
+
+    return invalid_paths
+
+
+def shard_filename(filename, shard, num_shards):
+    '''
+    return "name-0000k-of-0000N.ext" for sharded output.
+    filename is returned as it is if num_shards is 1
+    '''
+
+    if num_shards == 1:
+        return filename
+
+    root, ext = os.path.splitext(filename)
+    return "{}-{:05d}-of-{:05d}{}".format(root, shard, num_shards, ext)
+
+
+def init_worker(shared_counter):
+
+    global counter
+    counter = shared_counter
+
+
+def convert(input_filename, output_filename, lines, num_words, num_chars, embed_images, chunk_size=10000):
+
+    num_records = 0
 
     with tf.python_io.TFRecordWriter(output_filename) as writer:
 
-        with open(input_filename) as f:
+        # labelはchunk単位でまとめてencodeする
+        for begin in range(0, len(lines), chunk_size):
 
-            for line in tqdm(f):
+            paths, words = zip(*map(str.split, lines[begin:begin + chunk_size]))
+            labels = encode_labels(words, num_words, num_chars)
 
-                path, words = line.split()
-                path = os.path.join(os.path.dirname(input_filename), path)
+            for path, label in zip(paths, labels):
 
-                if invalid(path):
-                    print("invalid file: {}".format(path))
-                    continue
+                path = os.path.join(os.path.dirname(input_filename), path)
 
-                words = words.split("_")
-                words = map_innermost_list(lambda words: pad(words, num_words, ""), words)
-                words = map_innermost_element(lambda word: word.upper(), words)
-                chars = map_innermost_element(lambda word: list(word), words)
-                chars = map_innermost_list(lambda chars: pad(chars, num_chars, ""), chars)
-                label = map_innermost_element(lambda char: class_ids[char], chars)
-                label = flatten_innermost_element(label)
+                feature = {
+                    "path": tf.train.Feature(
+                        bytes_list=tf.train.BytesList(
+                            value=[path.encode("utf-8")]
+                        )
+                    ),
+                    "label": tf.train.Feature(
+                        int64_list=tf.train.Int64List(
+                            value=label.reshape(-1).tolist()
+                        )
+                    )
+                }
+                # 画像をrecordに埋め込んでおけば学習時にファイルを個別にopenしなくて済む
+                if embed_images:
+                    with open(path, "rb") as image:
+                        feature["image"] = tf.train.Feature(
+                            bytes_list=tf.train.BytesList(
+                                value=[image.read()]
+                            )
+                        )
 
                 writer.write(
                     record=tf.train.Example(
                         features=tf.train.Features(
-                            feature={
-                                "path": tf.train.Feature(
-                                    bytes_list=tf.train.BytesList(
-                                        value=[path.encode("utf-8")]
-                                    )
-                                ),
-                                "label": tf.train.Feature(
-                                    int64_list=tf.train.Int64List(
-                                        value=label
-                                    )
-                                )
-                            }
+                            feature=feature
                         )
                     ).SerializeToString()
                 )
 
+                num_records += 1
+
+            with counter.get_lock():
+                counter.value += len(paths)
+
+    # input_fnがshuffle bufferのサイズを決めるためのmanifest
+    dataset.write_manifest(output_filename, num_records)
+
+    return num_records
+
+
+def main(input_filename, output_filename, num_words, num_chars, embed_images, num_shards, num_processes,
+         validation, validation_cache):
+
+    with open(input_filename) as f:
+        lines = f.readlines()
+
+    # 壊れた画像を含む行はshardに分ける前に取り除く
+    paths = [os.path.join(os.path.dirname(input_filename), line.split()[0]) for line in lines]
+    invalid_paths = find_invalid(
+        paths=paths,
+        mode=validation,
+        cache_filename=validation_cache or "{}.validation.db".format(input_filename),
+        num_processes=num_processes
+    )
+    for path in sorted(invalid_paths):
+        print("invalid file: {}".format(path))
+    lines = [line for line, path in zip(lines, paths) if path not in invalid_paths]
+
+    # 連続した行を各shardに割り当てるので，shard数が同じなら出力は決定的
+    shards = [
+        lines[len(lines) * shard // num_shards:len(lines) * (shard + 1) // num_shards]
+        for shard in range(num_shards)
+    ]
+
+    shared_counter = multiprocessing.Value("L", 0)
+
+    with multiprocessing.Pool(
+        processes=min(num_processes, num_shards),
+        initializer=init_worker,
+        initargs=(shared_counter,)
+    ) as pool:
+
+        result = pool.starmap_async(convert, [
+            (input_filename, shard_filename(output_filename, shard, num_shards), lines, num_words, num_chars, embed_images)
+            for shard, lines in enumerate(shards)
+        ])
+
+        with tqdm(total=len(lines)) as progress:
+            while not result.ready():
+                result.wait(1.0)
+                progress.update(shared_counter.value - progress.n)
+
+        num_records = result.get()
+
+    print("{} records written to {} shard(s)".format(sum(num_records), num_shards))
+
 
 if __name__ == "__main__":
 
-    main(args.input_filename, args.output_filename, args.num_words, args.num_chars)
+    args = parser.parse_args()
+
+    main(args.input_filename, args.output_filename, args.num_words, args.num_chars,
+         args.embed_images, args.num_shards, args.num_processes,
+         args.validation, args.validation_cache)
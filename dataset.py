@@ -1,36 +1,102 @@
 import tensorflow as tf
 import numpy as np
 import functools
+import itertools
+import json
 import os
 
 
-def parse_example(example, sequence_lengths, encoding, image_size, data_format):
+def manifest_filename(filename):
+
+    return "{}.json".format(filename)
+
+
+def write_manifest(filename, num_records):
+
+    with open(manifest_filename(filename), "w") as f:
+        json.dump(dict(num_records=num_records), f)
+
+
+def read_manifest(filename):
+    '''
+    return number of records written in manifest.
+    return None if manifest doesn't exist (e.g. tfrecord made by older converter)
+    '''
+
+    try:
+        with open(manifest_filename(filename)) as f:
+            return json.load(f)["num_records"]
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def feature_spec(sequence_lengths):
+
+    return {
+        "path": tf.FixedLenFeature(
+            shape=[],
+            dtype=tf.string,
+            default_value=""
+        ),
+        "image": tf.FixedLenFeature(
+            shape=[],
+            dtype=tf.string,
+            default_value=""
+        ),
+        "label": tf.FixedLenFeature(
+            shape=[np.prod(sequence_lengths)],
+            dtype=tf.int64
+        )
+    }
 
-    features = tf.parse_single_example(
-        serialized=example,
-        features={
-            "path": tf.FixedLenFeature(
-                shape=[],
-                dtype=tf.string
-            ),
-            "label": tf.FixedLenFeature(
-                shape=[np.prod(sequence_lengths)],
-                dtype=tf.int64
-            )
-        }
-    )
 
-    image = tf.cast(features["path"], tf.string)
-    image = tf.read_file(image)
+def decode_image(image, path, encoding):
+
+    # 画像が埋め込まれていないrecordはpathから読み込む
+    image = tf.cond(
+        pred=tf.equal(image, ""),
+        true_fn=lambda: tf.read_file(path),
+        false_fn=lambda: image
+    )
     if encoding == "jpeg":
         image = tf.image.decode_jpeg(image, 3)
     elif encoding == "png":
         image = tf.image.decode_png(image, 3)
-    image = tf.image.convert_image_dtype(image, tf.float32)
-    if image_size:
-        image = tf.image.resize_images(image, image_size)
-    if data_format == "channels_first":
-        image = tf.transpose(image, [2, 0, 1])
+    else:
+        # encodingを指定しない場合は内容から判定する (jpegとpngの混在したディレクトリなど)
+        image = tf.image.decode_image(image, 3, expand_animations=False)
+        image.set_shape([None, None, 3])
+
+    return image
+
+
+def preprocess_image(image, image_size, data_format, keep_uint8):
+
+    if keep_uint8:
+        # shuffle buffer, batch, prefetchでのメモリを節約するためuint8のまま返す
+        # floatへの変換とtransposeはモデル側(ops.convert_images)で行う
+        if image_size:
+            image = tf.image.resize_images(image, image_size)
+            image = tf.saturate_cast(tf.round(image), tf.uint8)
+    else:
+        image = tf.image.convert_image_dtype(image, tf.float32)
+        if image_size:
+            image = tf.image.resize_images(image, image_size)
+        if data_format == "channels_first":
+            image = tf.transpose(image, [2, 0, 1])
+
+    return image
+
+
+def parse_example(example, sequence_lengths, encoding, image_size, data_format, keep_uint8=False):
+
+    features = tf.parse_single_example(
+        serialized=example,
+        features=feature_spec(sequence_lengths)
+    )
+
+    image = decode_image(features["image"], features["path"], encoding)
+    image = preprocess_image(image, image_size, data_format, keep_uint8)
 
     label = tf.cast(features["label"], tf.int32)
     label = tf.reshape(label, sequence_lengths)
@@ -38,33 +104,297 @@ def parse_example(example, sequence_lengths, encoding, image_size, data_format):
     return image, label
 
 
-def input_fn(filenames, batch_size, num_epochs, shuffle,
-             sequence_lengths, encoding, image_size, data_format):
+def parse_examples(examples, sequence_lengths, encoding, image_size, data_format, keep_uint8=False):
+    '''
+    batched version of parse_example.
+    batch of records is parsed at once by tf.parse_example and images are decoded by parallel inner map.
+    image_size is required to stack decoded images
+    '''
 
-    dataset = tf.data.TFRecordDataset(
-        filenames=filenames,
-        num_parallel_reads=os.cpu_count()
+    features = tf.parse_example(
+        serialized=examples,
+        features=feature_spec(sequence_lengths)
+    )
+
+    images = tf.map_fn(
+        fn=lambda image_path: preprocess_image(
+            image=decode_image(*image_path, encoding),
+            image_size=image_size,
+            data_format=data_format,
+            keep_uint8=keep_uint8
+        ),
+        elems=(features["image"], features["path"]),
+        dtype=tf.uint8 if keep_uint8 else tf.float32,
+        parallel_iterations=os.cpu_count(),
+        back_prop=False
     )
+
+    labels = tf.cast(features["label"], tf.int32)
+    labels = tf.reshape(labels, [-1, *sequence_lengths])
+
+    return images, labels
+
+
+def load_pipeline_config(filename):
+    '''
+    load input pipeline config written by dataset_benchmark.py.
+    "autotune" is replaced with tf.data.experimental.AUTOTUNE
+    '''
+
+    with open(filename) as f:
+        config = json.load(f)
+
+    return {
+        key: tf.data.experimental.AUTOTUNE if value == "autotune" else value
+        for key, value in config.items()
+    }
+
+
+def make_dataset(filenames, batch_size, num_epochs, shuffle,
+                 sequence_lengths, encoding, image_size, data_format,
+                 shuffle_buffer_size=10000, keep_uint8=False, parse_batch=False,
+                 num_parallel_reads=None, num_parallel_calls=None, prefetch_buffer_size=1):
+    '''
+    num_parallel_reads, num_parallel_calls: default to os.cpu_count().
+    num_parallel_calls, prefetch_buffer_size: tf.data.experimental.AUTOTUNE is also accepted
+    '''
+
+    num_parallel_reads = num_parallel_reads or os.cpu_count()
+    num_parallel_calls = num_parallel_calls or os.cpu_count()
+
     if shuffle:
+        # ファイル(shard)の順番をシャッフルしてからinterleaveし，
+        # 最後に固定サイズのbufferでrecordをシャッフルする
+        # bufferはmanifestのrecord数より大きくする必要はない
+        num_records = list(map(read_manifest, filenames))
+        if None not in num_records:
+            shuffle_buffer_size = min(shuffle_buffer_size, sum(num_records))
+        dataset = tf.data.Dataset.from_tensor_slices(filenames)
+        dataset = dataset.shuffle(
+            buffer_size=len(filenames),
+            reshuffle_each_iteration=True
+        )
+        dataset = dataset.apply(tf.data.experimental.parallel_interleave(
+            map_func=tf.data.TFRecordDataset,
+            cycle_length=min(len(filenames), num_parallel_reads),
+            block_length=1,
+            sloppy=True
+        ))
         dataset = dataset.shuffle(
-            buffer_size=sum([
-                len(list(tf.io.tf_record_iterator(filename)))
-                for filename in filenames
-            ]),
+            buffer_size=max(shuffle_buffer_size, 1),
             reshuffle_each_iteration=True
         )
+    else:
+        dataset = tf.data.TFRecordDataset(
+            filenames=filenames,
+            num_parallel_reads=num_parallel_reads
+        )
     dataset = dataset.repeat(count=num_epochs)
+    # parse_batch: serialized recordのままbatchしてからまとめてparseする
+    if parse_batch:
+        dataset = dataset.batch(batch_size=batch_size)
     dataset = dataset.map(
         map_func=functools.partial(
-            parse_example,
+            parse_examples if parse_batch else parse_example,
             sequence_lengths=sequence_lengths,
             encoding=encoding,
             image_size=image_size,
-            data_format=data_format
+            data_format=data_format,
+            keep_uint8=keep_uint8
         ),
-        num_parallel_calls=os.cpu_count()
+        num_parallel_calls=num_parallel_calls
     )
-    dataset = dataset.batch(batch_size=batch_size)
+    if not parse_batch:
+        dataset = dataset.batch(batch_size=batch_size)
+    dataset = dataset.prefetch(buffer_size=prefetch_buffer_size)
+
+    return dataset
+
+
+def input_fn(filenames, batch_size, num_epochs, shuffle,
+             sequence_lengths, encoding, image_size, data_format,
+             pipeline_config=None, **kwargs):
+    '''
+    pipeline_config: filename of config written by dataset_benchmark.py (optional).
+    other keyword arguments are passed to make_dataset
+    '''
+
+    if pipeline_config:
+        kwargs.update(load_pipeline_config(pipeline_config))
+
+    dataset = make_dataset(
+        filenames=filenames,
+        batch_size=batch_size,
+        num_epochs=num_epochs,
+        shuffle=shuffle,
+        sequence_lengths=sequence_lengths,
+        encoding=encoding,
+        image_size=image_size,
+        data_format=data_format,
+        **kwargs
+    )
+
+    return dataset.make_one_shot_iterator().get_next()
+
+
+def image_store_filenames(filename_prefix):
+
+    return "{}.images.npy".format(filename_prefix), "{}.labels.npy".format(filename_prefix)
+
+
+def memmap_input_fn(filename_prefix, batch_size, num_epochs, shuffle, data_format, keep_uint8=False):
+    '''
+    input_fn for image store made by make_image_store.py.
+    images are already decoded and resized, and served from memory-mapped uint8 array.
+    batches are read (copied) from the array, so only decoding and resizing are saved
+    '''
+
+    images_filename, labels_filename = image_store_filenames(filename_prefix)
+    images = np.load(images_filename, mmap_mode="r")
+    labels = np.load(labels_filename, mmap_mode="r")
+
+    def generator():
+
+        for _ in (itertools.count() if num_epochs is None else range(num_epochs)):
+
+            if shuffle:
+                indices = np.random.permutation(len(images))
+                for begin in range(0, len(indices), batch_size):
+                    # ページキャッシュ上で連続して読めるようにバッチ内はソート
+                    batch = np.sort(indices[begin:begin + batch_size])
+                    yield images[batch], labels[batch]
+            else:
+                # 連続領域を順に読む (from_generatorはyieldされた配列をtensorにコピーする)
+                for begin in range(0, len(images), batch_size):
+                    yield images[begin:begin + batch_size], labels[begin:begin + batch_size]
+
+    def preprocess(images, labels):
+
+        images = tf.image.convert_image_dtype(images, tf.float32)
+        if data_format == "channels_first":
+            images = tf.transpose(images, [0, 3, 1, 2])
+
+        return images, labels
+
+    dataset = tf.data.Dataset.from_generator(
+        generator=generator,
+        output_types=(tf.uint8, tf.int32),
+        output_shapes=([None, *images.shape[1:]], [None, *labels.shape[1:]])
+    )
+    if not keep_uint8:
+        dataset = dataset.map(
+            map_func=preprocess,
+            num_parallel_calls=os.cpu_count()
+        )
     dataset = dataset.prefetch(buffer_size=1)
 
     return dataset.make_one_shot_iterator().get_next()
+
+
+def predict_input_fn(filenames, batch_size, encoding, image_size, data_format, keep_uint8=False,
+                     num_shards=1, shard=0, num_parallel_calls=tf.data.experimental.AUTOTUNE):
+    '''
+    input_fn for prediction over tfrecords (*.tfrecord) or image files.
+    image files are decoded by their content, so jpeg and png files can be mixed (encoding is used for tfrecords).
+    features are dict(images, paths) so that each prediction can be associated with its image.
+    records (or images) shard, shard + num_shards, shard + 2 * num_shards, ... are used
+    '''
+
+    def parse_record(example):
+
+        features = tf.parse_single_example(
+            serialized=example,
+            features={key: value for key, value in feature_spec([]).items() if key != "label"}
+        )
+
+        return features["image"], features["path"]
+
+    if all(filename.endswith(".tfrecord") for filename in filenames):
+        dataset = tf.data.TFRecordDataset(filenames).shard(num_shards, shard)
+        dataset = dataset.map(parse_record)
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(filenames).shard(num_shards, shard)
+        dataset = dataset.map(lambda path: (tf.constant(""), path))
+        encoding = None
+
+    dataset = dataset.map(
+        map_func=lambda image, path: dict(
+            images=preprocess_image(decode_image(image, path, encoding), image_size, data_format, keep_uint8),
+            paths=path
+        ),
+        num_parallel_calls=num_parallel_calls
+    )
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.prefetch(buffer_size=1)
+
+    return dataset.make_one_shot_iterator().get_next()
+
+
+def serving_input_receiver_fn(encoding, image_size):
+    '''
+    serving input of encoded image bytes [batch_size] for SavedModel export.
+    decoding and resizing are included in the graph and images are fed to the model as uint8 (keep_uint8)
+    '''
+
+    encoded_images = tf.placeholder(
+        dtype=tf.string,
+        shape=[None],
+        name="encoded_images"
+    )
+
+    images = tf.map_fn(
+        fn=lambda image: preprocess_image(
+            image=tf.image.decode_jpeg(image, 3) if encoding == "jpeg" else tf.image.decode_png(image, 3),
+            image_size=image_size,
+            data_format="channels_last",
+            keep_uint8=True
+        ),
+        elems=encoded_images,
+        dtype=tf.uint8,
+        back_prop=False
+    )
+
+    # ServingInputReceiverはtensorを{"feature": images}に包むので，tensorのままモデルに渡す
+    return tf.estimator.export.TensorServingInputReceiver(
+        features=images,
+        receiver_tensors=dict(images=encoded_images)
+    )
+
+
+def image_serving_input_receiver_fn(image_size):
+    '''
+    serving input of decoded uint8 images [batch_size, height, width, 3] for SavedModel export.
+    graph has no string ops so that it can be converted to tflite (quantize_model.py)
+    '''
+
+    images = tf.placeholder(
+        dtype=tf.uint8,
+        shape=[None, *image_size, 3],
+        name="images"
+    )
+
+    return tf.estimator.export.TensorServingInputReceiver(
+        features=images,
+        receiver_tensors=dict(images=images)
+    )
+
+
+def load_encoded_images(filenames, num_images):
+    '''
+    encoded images embedded in tfrecords (or read from paths of records)
+    for SavedModels exported with serving_input_receiver_fn
+    '''
+
+    def encoded_image(record):
+
+        example = tf.train.Example.FromString(record)
+        features = example.features.feature
+        # convert_dataset.py --embed_imagesで埋め込まれた画像
+        if "image" in features and features["image"].bytes_list.value:
+            return features["image"].bytes_list.value[0]
+        with open(features["path"].bytes_list.value[0].decode("utf-8"), "rb") as f:
+            return f.read()
+
+    records = itertools.chain.from_iterable(map(tf.python_io.tf_record_iterator, filenames))
+
+    return [encoded_image(record) for record in itertools.islice(records, num_images)]
@@ -0,0 +1,196 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+import itertools
+import json
+import time
+import os
+import dataset
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--setting", type=str, default="synth90k", choices=["chars74k", "synth90k", "multi_synth90k"], help="input setting of entry script")
+parser.add_argument("--filenames", type=str, nargs="+", default=None, help="tfrecords (default: training tfrecord of the setting)")
+parser.add_argument("--batch_size", type=int, default=100, help="batch size")
+parser.add_argument("--num_batches", type=int, default=100, help="number of measured batches")
+parser.add_argument("--warmup_batches", type=int, default=10, help="number of batches before measurement")
+parser.add_argument("--data_format", type=str, default="channels_first", help="data format")
+parser.add_argument("--num_parallel_reads", type=str, nargs="+", default=["1", "2", "4", str(os.cpu_count())], help="candidates of num_parallel_reads")
+parser.add_argument("--num_parallel_calls", type=str, nargs="+", default=["1", "2", "4", str(os.cpu_count()), "autotune"], help="candidates of num_parallel_calls")
+parser.add_argument("--prefetch_buffer_sizes", type=str, nargs="+", default=["1", "2", "4", "autotune"], help="candidates of prefetch_buffer_size")
+parser.add_argument("--output_filename", type=str, default="pipeline_config.json", help="best config is written here (loaded by input_fn(pipeline_config=...))")
+
+# chars74k_main.py, synth90k_main.py, multi_synth90k_main.pyの学習時の設定
+settings = dict(
+    chars74k=dict(filenames=["chars74k_train.tfrecord"], sequence_lengths=[], encoding="png", image_size=[128, 128]),
+    synth90k=dict(filenames=["synth90k_train.tfrecord"], sequence_lengths=[24], encoding="jpeg", image_size=[256, 256]),
+    multi_synth90k=dict(filenames=["multi_synth90k_train.tfrecord"], sequence_lengths=[5, 11], encoding="jpeg", image_size=[256, 256]),
+)
+
+stages = ["read", "parse", "decode", "resize", "batch"]
+
+
+def parse_value(value):
+
+    return value if value == "autotune" else int(value)
+
+
+def resolve_value(value):
+
+    return tf.data.experimental.AUTOTUNE if value == "autotune" else value
+
+
+def stage_dataset(stage, filenames, batch_size, sequence_lengths, encoding, image_size, data_format,
+                  num_parallel_reads, num_parallel_calls, prefetch_buffer_size):
+    '''
+    input pipeline cut after given stage.
+    each element is single tensor so that it can be counted by Dataset.reduce
+    '''
+
+    if stage == "batch":
+        return dataset.make_dataset(
+            filenames=filenames,
+            batch_size=batch_size,
+            num_epochs=None,
+            shuffle=False,
+            sequence_lengths=sequence_lengths,
+            encoding=encoding,
+            image_size=image_size,
+            data_format=data_format,
+            num_parallel_reads=num_parallel_reads,
+            num_parallel_calls=num_parallel_calls,
+            prefetch_buffer_size=prefetch_buffer_size
+        ).map(lambda images, labels: images)
+
+    def map_func(example):
+
+        features = tf.parse_single_example(
+            serialized=example,
+            features=dataset.feature_spec(sequence_lengths)
+        )
+        if stage == "parse":
+            return features["label"]
+
+        image = dataset.decode_image(features["image"], features["path"], encoding)
+        if stage == "decode":
+            return image
+
+        return dataset.preprocess_image(image, image_size, data_format, keep_uint8=False)
+
+    pipeline = tf.data.TFRecordDataset(
+        filenames=filenames,
+        num_parallel_reads=num_parallel_reads
+    ).repeat()
+
+    if stage != "read":
+        pipeline = pipeline.map(
+            map_func=map_func,
+            num_parallel_calls=num_parallel_calls
+        )
+
+    return pipeline.prefetch(buffer_size=prefetch_buffer_size)
+
+
+def measure(pipeline, num_elements, warmup_elements):
+    '''
+    return elements/sec.
+    elements are counted by Dataset.reduce inside the graph so that session.run overhead is not included
+    '''
+
+    warmup_op = pipeline.take(warmup_elements).reduce(np.int64(0), lambda count, _: count + 1)
+    count_op = pipeline.take(num_elements).reduce(np.int64(0), lambda count, _: count + 1)
+
+    with tf.Session() as session:
+
+        session.run(warmup_op)
+
+        begin = time.time()
+        count = session.run(count_op)
+
+        return count / (time.time() - begin)
+
+
+def benchmark(stage, setting, args, **config):
+
+    with tf.Graph().as_default():
+
+        images_per_element = args.batch_size if stage == "batch" else 1
+
+        return measure(
+            pipeline=stage_dataset(
+                stage=stage,
+                batch_size=args.batch_size,
+                data_format=args.data_format,
+                **setting,
+                **{key: resolve_value(value) for key, value in config.items()}
+            ),
+            num_elements=args.num_batches * args.batch_size // images_per_element,
+            warmup_elements=args.warmup_batches * args.batch_size // images_per_element
+        ) * images_per_element
+
+
+def compare_parse_order(setting, args):
+    '''
+    images/sec of parse-then-batch (default) and batch-then-parse (parse_batch=True)
+    '''
+
+    for parse_batch in [False, True]:
+
+        with tf.Graph().as_default():
+
+            pipeline = dataset.make_dataset(
+                batch_size=args.batch_size,
+                num_epochs=None,
+                shuffle=True,
+                data_format=args.data_format,
+                parse_batch=parse_batch,
+                **setting
+            ).map(lambda images, labels: images)
+
+            images_per_sec = measure(pipeline, args.num_batches, args.warmup_batches) * args.batch_size
+
+        print("    {:<16} {:.1f} images/sec".format("batch-then-parse" if parse_batch else "parse-then-batch", images_per_sec))
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    setting = dict(settings[args.setting])
+    setting.update(filenames=args.filenames or setting["filenames"])
+
+    default_config = dict(num_parallel_reads=os.cpu_count(), num_parallel_calls=os.cpu_count(), prefetch_buffer_size=1)
+
+    print("==================================================")
+    print("stages ({}, default config: {})".format(args.setting, default_config))
+    # 各stageで切ったpipelineのthroughputが大きく落ちる箇所がボトルネック
+    for stage in stages:
+        print("    {:<8} {:.1f} images/sec".format(stage, benchmark(stage, setting, args, **default_config)))
+
+    print("==================================================")
+    print("parse order ({})".format(args.setting))
+    compare_parse_order(setting, args)
+
+    print("==================================================")
+    print("sweep ({})".format(args.setting))
+    results = []
+    for num_parallel_reads, num_parallel_calls, prefetch_buffer_size in itertools.product(
+        map(int, args.num_parallel_reads),
+        map(parse_value, args.num_parallel_calls),
+        map(parse_value, args.prefetch_buffer_sizes)
+    ):
+        config = dict(
+            num_parallel_reads=num_parallel_reads,
+            num_parallel_calls=num_parallel_calls,
+            prefetch_buffer_size=prefetch_buffer_size
+        )
+        images_per_sec = benchmark("batch", setting, args, **config)
+        results.append((images_per_sec, config))
+        print("    {}: {:.1f} images/sec".format(config, images_per_sec))
+
+    images_per_sec, config = max(results, key=lambda result: result[0])
+
+    with open(args.output_filename, "w") as f:
+        json.dump(config, f, indent=4)
+
+    print("==================================================")
+    print("best config: {} ({:.1f} images/sec) => {}".format(config, images_per_sec, args.output_filename))
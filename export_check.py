@@ -0,0 +1,167 @@
+# =============================================================
+# check that --export and --export_numeric build serving graphs
+# of HATS (synth90k_main.py) and Classifier (chars74k_main.py),
+# and that the exported SavedModels predict.
+# variables are randomly initialized (no training)
+# usage:
+#   python export_check.py --data_format channels_last
+# =============================================================
+
+import tensorflow as tf
+import numpy as np
+import argparse
+import functools
+import tempfile
+import os
+import dataset
+import inference
+from convert_dataset import class_ids
+from models.hats import HATS
+from models.classifier import Classifier
+from networks.attention_network import AttentionNetwork
+from networks.pyramid_resnet import PyramidResNet
+from attrdict import AttrDict as Param
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--data_format", type=str, default="channels_last", help="data format (channels_first requires GPU)")
+parser.add_argument("--batch_size", type=int, default=2, help="number of images fed to exported models")
+parser.add_argument("--random_seed", type=int, default=1209, help="random seed")
+
+
+def backbone_network(data_format):
+
+    return PyramidResNet(
+        conv_param=Param(filters=64, kernel_size=[7, 7], strides=[2, 2]),
+        pool_param=None,
+        residual_params=[
+            Param(filters=64, strides=[2, 2], blocks=2),
+            Param(filters=128, strides=[2, 2], blocks=2),
+            Param(filters=256, strides=[2, 2], blocks=2),
+            Param(filters=512, strides=[2, 2], blocks=2),
+        ],
+        data_format=data_format
+    )
+
+
+def hats_model_fn(features, labels, mode, data_format, numeric):
+    # synth90k_main.pyのHATS
+
+    return HATS(
+        backbone_network=backbone_network(data_format),
+        attention_network=AttentionNetwork(
+            conv_params=[
+                Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
+                Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
+            ],
+            rnn_params=[
+                Param(sequence_length=24, num_units=256),
+            ],
+            deconv_params=[
+                Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
+                Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
+            ],
+            data_format=data_format,
+            hoisted_lstm=True,
+            batched_levels=True,
+            batched_deconv=True
+        ),
+        num_units=[1024],
+        num_classes=37,
+        data_format=data_format,
+        hyper_params=None,
+        batched_pooling=True,
+        stacked_heads=True,
+        early_exit=not numeric,
+        class_names=sorted(class_ids, key=class_ids.get),
+        prediction_outputs=["predictions"] if numeric else ["strings", "attention_maps"]
+    )(features, labels, mode, Param(training=False))
+
+
+def classifier_model_fn(features, labels, mode, data_format, numeric):
+    # chars74k_main.pyのClassifier
+
+    return Classifier(
+        backbone_network=backbone_network(data_format),
+        num_classes=37,
+        data_format=data_format,
+        hyper_params=None,
+        class_names=sorted(class_ids, key=class_ids.get),
+        prediction_outputs=["predictions"] if numeric else ["predictions", "strings"]
+    )(features, labels, mode)
+
+
+def export(model_fn, serving_input_receiver_fn, export_dir_base):
+    '''
+    export SavedModel of randomly initialized variables by Estimator.export_saved_model as *_main.py --export
+    '''
+
+    model_dir = tempfile.mkdtemp(dir=export_dir_base)
+
+    # prediction modeの変数だけのcheckpointを作る
+    with tf.Graph().as_default():
+
+        model_fn(serving_input_receiver_fn().features, None, tf.estimator.ModeKeys.PREDICT)
+        tf.train.get_or_create_global_step()
+
+        with tf.Session() as session:
+
+            session.run(tf.global_variables_initializer())
+            tf.train.Saver().save(session, os.path.join(model_dir, "model.ckpt"), global_step=0)
+
+    estimator = tf.estimator.Estimator(
+        model_fn=model_fn,
+        model_dir=model_dir
+    )
+
+    return estimator.export_saved_model(export_dir_base, serving_input_receiver_fn).decode("utf-8")
+
+
+def encode_images(images, encoding):
+
+    with tf.Graph().as_default(), tf.Session() as session:
+
+        image = tf.placeholder(tf.uint8, shape=images.shape[1:])
+        encoded_image = tf.image.encode_jpeg(image) if encoding == "jpeg" else tf.image.encode_png(image)
+
+        return [session.run(encoded_image, feed_dict={image: array}) for array in images]
+
+
+def check(name, model_fn, image_size, encoding, args):
+
+    export_dir_base = tempfile.mkdtemp()
+
+    images = np.random.randint(0, 256, size=[args.batch_size, *image_size, 3], dtype=np.uint8)
+    settings = [
+        # --export (encoded image input)
+        ("export", False, functools.partial(dataset.serving_input_receiver_fn, encoding=encoding, image_size=image_size), encode_images(images, encoding)),
+        # --export_numeric (uint8 image input)
+        ("export_numeric", True, functools.partial(dataset.image_serving_input_receiver_fn, image_size=image_size), images),
+    ]
+
+    for setting, numeric, serving_input_receiver_fn, inputs in settings:
+
+        saved_model_dir = export(
+            model_fn=functools.partial(model_fn, data_format=args.data_format, numeric=numeric),
+            serving_input_receiver_fn=serving_input_receiver_fn,
+            export_dir_base=export_dir_base
+        )
+
+        outputs = inference.SavedModelPredictor(saved_model_dir)(inputs)
+
+        for key, value in outputs.items():
+            assert len(value) == args.batch_size, (name, setting, key)
+
+        print("{:<12} {:<16} {}".format(name, setting, ", ".join(
+            "{}: {}".format(key, list(value.shape)) for key, value in sorted(outputs.items())
+        )))
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    np.random.seed(args.random_seed)
+    tf.set_random_seed(args.random_seed)
+
+    check("hats", hats_model_fn, [256, 256], "jpeg", args)
+    check("classifier", classifier_model_fn, [128, 128], "png", args)
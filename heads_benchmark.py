@@ -0,0 +1,84 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+from models.hats import HATS
+from benchmark_utils import measure, moving_statistics
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=100, help="batch size")
+parser.add_argument("--num_features", type=int, default=8192, help="size of feature vectors (C' * C of attention pooling)")
+parser.add_argument("--num_positions", type=int, default=24, help="number of characters (synth90k_main.py: 24)")
+parser.add_argument("--number", type=int, default=10, help="number of measured runs")
+parser.add_argument("--random_seed", type=int, default=1209, help="random seed")
+
+# synth90k_main.pyのFC層とlogit
+hats = HATS(
+    backbone_network=None,
+    attention_network=None,
+    num_units=[1024],
+    num_classes=37,
+    data_format="channels_first",
+    hyper_params=None
+)
+
+
+def benchmark(args):
+
+    for training in [True, False]:
+
+        with tf.Graph().as_default():
+
+            feature_vectors = [
+                tf.constant(np.random.uniform(size=[args.batch_size, args.num_features]), dtype=tf.float32)
+                for _ in range(args.num_positions)
+            ]
+
+            # 同じ変数を共有する
+            results = []
+            for option in ["per_element", "stacked"]:
+                num_update_ops = len(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+                with tf.variable_scope("hats", reuse=tf.AUTO_REUSE):
+                    if option == "stacked":
+                        logits = tf.split(hats.classify(tf.concat(feature_vectors, axis=0), training, num_groups=len(feature_vectors)), len(feature_vectors))
+                    else:
+                        logits = [hats.classify(inputs, training) for inputs in feature_vectors]
+                logits = tf.stack(logits, axis=1)
+                gradients = tf.gradients(tf.reduce_sum(logits), tf.trainable_variables())
+                update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)[num_update_ops:]
+                results.append((option, logits, gradients, update_ops))
+
+            moving_variables = [variable for variable in tf.global_variables() if "moving_" in variable.name]
+
+            with tf.Session() as session:
+
+                session.run(tf.global_variables_initializer())
+
+                # batch normalizationは位置ごとの統計量を使うので，trainingでもper_elementと一致する
+                # 移動統計はper_elementの各位置の更新を順に適用したものと一致する
+                reference_logits, reference_gradients = session.run(results[0][1:3])
+                reference_moving_statistics = moving_statistics(session, results[0][3], moving_variables)
+                for option, logits, gradients, update_ops in results[1:]:
+                    logits, gradients = session.run([logits, gradients])
+                    assert np.allclose(logits, reference_logits, atol=1e-5), option
+                    for gradient, reference_gradient in zip(gradients, reference_gradients):
+                        assert np.allclose(gradient, reference_gradient, rtol=1e-3, atol=1e-4), option
+                    for statistics, reference_statistics in zip(moving_statistics(session, update_ops, moving_variables), reference_moving_statistics):
+                        assert np.allclose(statistics, reference_statistics, rtol=1e-4, atol=1e-6), option
+
+                for option, logits, gradients, update_ops in results:
+                    print("{:<12} training={:<6} forward: {:.3e} sec, forward + backward + update: {:.3e} sec".format(
+                        option,
+                        str(training),
+                        measure(session, logits, args.number),
+                        measure(session, [logits, gradients, update_ops], args.number)
+                    ))
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    np.random.seed(args.random_seed)
+    tf.set_random_seed(args.random_seed)
+
+    benchmark(args)
@@ -0,0 +1,150 @@
+import tensorflow as tf
+import multiprocessing
+import itertools
+import glob
+import time
+import os
+import prediction_writer
+
+
+image_extensions = (".jpg", ".jpeg", ".png")
+
+
+def expand_filenames(patterns):
+    '''
+    expand glob patterns in given order (each pattern is sorted).
+    directories are expanded to image files under them (sorted)
+    '''
+
+    def expand_directory(filename):
+
+        if not os.path.isdir(filename):
+            return [filename]
+
+        return sorted(
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(filename)
+            for name in names if name.lower().endswith(image_extensions)
+        )
+
+    filenames = itertools.chain.from_iterable(sorted(glob.glob(pattern)) or [pattern] for pattern in patterns)
+
+    return list(itertools.chain.from_iterable(map(expand_directory, filenames)))
+
+
+def part_filename_prefix(filename_prefix, shard, num_shards):
+
+    return "{}.part-{:05d}-of-{:05d}".format(filename_prefix, shard, num_shards)
+
+
+def predict(estimator_fn, input_fn, filename_prefix, shard_size):
+    '''
+    write all prediction outputs of input_fn by PredictionWriter and return number of images
+    '''
+
+    estimator = estimator_fn()
+
+    with prediction_writer.PredictionWriter(filename_prefix, shard_size) as writer:
+
+        for prediction in estimator.predict(input_fn=input_fn):
+            writer.write(prediction)
+
+        return writer.num_records
+
+
+def run(estimator_fn, input_fn, output_filename_prefix, num_processes=1, shard_size=10000):
+    '''
+    batch inference split across num_processes processes.
+    estimator_fn(): returns tf.estimator.Estimator whose model outputs prediction_outputs and "paths"
+    input_fn(shard, num_shards): input_fn of the shard (e.g. dataset.predict_input_fn)
+    predictions are written to compressed shards "<output_filename_prefix>-00000.npz", ... (prediction_writer)
+    in the input order, and can be read by prediction_writer.read_predictions.
+    with multiple processes, each process writes its shard to part files, then part files are merged in the input order.
+    processes are forked, so that estimator_fn and input_fn need not to be picklable.
+    forking after a tensorflow session has run in this process is unsafe,
+    so multiple processes must not be used after training or evaluation in the same process
+    '''
+
+    begin = time.time()
+
+    if num_processes == 1:
+
+        num_images = predict(
+            estimator_fn=estimator_fn,
+            input_fn=lambda: input_fn(shard=0, num_shards=1),
+            filename_prefix=output_filename_prefix,
+            shard_size=shard_size
+        )
+
+    else:
+
+        processes = [
+            multiprocessing.get_context("fork").Process(
+                target=predict,
+                args=(
+                    estimator_fn,
+                    lambda shard=shard: input_fn(shard=shard, num_shards=num_processes),
+                    part_filename_prefix(output_filename_prefix, shard, num_processes),
+                    shard_size
+                )
+            )
+            for shard in range(num_processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        if any(process.exitcode for process in processes):
+            raise RuntimeError("prediction failed in {} process(es)".format(sum(bool(process.exitcode) for process in processes)))
+
+        part_filename_prefixes = [part_filename_prefix(output_filename_prefix, shard, num_processes) for shard in range(num_processes)]
+        num_images = 0
+
+        # shard kはk, k + num_shards, ...番目の画像なので交互に取り出すと入力順に戻る
+        with prediction_writer.PredictionWriter(output_filename_prefix, shard_size) as writer:
+            for prediction in itertools.chain.from_iterable(itertools.zip_longest(*map(prediction_writer.read_predictions, part_filename_prefixes))):
+                if prediction is not None:
+                    writer.write(prediction)
+                    num_images += 1
+
+        for filename in itertools.chain.from_iterable(map(prediction_writer.shard_filenames, part_filename_prefixes)):
+            os.remove(filename)
+
+    elapsed_time = time.time() - begin
+
+    print("{} images predicted by {} process(es) in {:.1f} sec ({:.1f} images/sec) => {}-*.npz".format(
+        num_images, num_processes, elapsed_time, num_images / elapsed_time, output_filename_prefix
+    ))
+
+
+def load_signature(session, saved_model_dir):
+    '''
+    load SavedModel into session and return serving signature
+    '''
+
+    meta_graph_def = tf.saved_model.loader.load(session, [tf.saved_model.tag_constants.SERVING], saved_model_dir)
+
+    return meta_graph_def.signature_def[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+
+
+class SavedModelPredictor(object):
+    '''
+    session of SavedModel with single input (encoded images, or uint8 images of --export_numeric).
+    returns dict of outputs for list of encoded images
+    '''
+
+    def __init__(self, saved_model_dir, config=None):
+
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph, config=config or tf.ConfigProto(device_count=dict(GPU=0)))
+
+        with self.graph.as_default():
+            signature = load_signature(self.session, saved_model_dir)
+
+        self.input_name, = [tensor_info.name for tensor_info in signature.inputs.values()]
+        self.output_names = {key: tensor_info.name for key, tensor_info in signature.outputs.items()}
+
+    def __call__(self, encoded_images):
+
+        return self.session.run(self.output_names, feed_dict={self.input_name: encoded_images})
@@ -0,0 +1,69 @@
+import numpy as np
+import argparse
+import random
+import string
+import time
+import convert_dataset
+from algorithms import *
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--num_lines", type=int, default=100000, help="number of ground truth lines")
+parser.add_argument("--random_seed", type=int, default=1209, help="random seed")
+
+
+def pad(sequence, sequence_length, value):
+    while len(sequence) < sequence_length:
+        sequence.append(value)
+    return sequence
+
+
+def encode_label(words, num_words, num_chars):
+    '''
+    per-line label encoding previously used by convert_dataset.py (reference implementation)
+    '''
+
+    words = words.split("_")
+    words = map_innermost_list(lambda words: pad(words, num_words, ""), words)
+    words = map_innermost_element(lambda word: word.upper(), words)
+    chars = map_innermost_element(lambda word: list(word), words)
+    chars = map_innermost_list(lambda chars: pad(chars, num_chars, ""), chars)
+    label = map_innermost_element(lambda char: convert_dataset.class_ids[char], chars)
+    label = flatten_innermost_element(label)
+
+    return label
+
+
+def benchmark(name, num_lines, num_words, num_chars):
+
+    strings = [
+        "_".join(
+            "".join(random.choice(string.ascii_letters + string.digits) for _ in range(random.randint(1, num_chars - 1)))
+            for _ in range(random.randint(1, num_words))
+        )
+        for _ in range(num_lines)
+    ]
+
+    begin = time.time()
+    reference = [encode_label(words, num_words, num_chars) for words in strings]
+    reference_time = time.time() - begin
+
+    begin = time.time()
+    labels = convert_dataset.encode_labels(strings, num_words, num_chars)
+    vectorized_time = time.time() - begin
+
+    assert np.array_equal(labels.reshape([num_lines, -1]), np.array(reference))
+
+    print("{}: [num_words, num_chars] = [{}, {}]".format(name, num_words, num_chars))
+    print("    reference:  {:.0f} lines/sec".format(num_lines / reference_time))
+    print("    vectorized: {:.0f} lines/sec".format(num_lines / vectorized_time))
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    random.seed(args.random_seed)
+
+    # synth90k_main.py (sequence_lengths=[24]) and multi_synth90k_main.py (sequence_lengths=[5, 11])
+    benchmark("synth90k", args.num_lines, 1, 24)
+    benchmark("multi_synth90k", args.num_lines, 5, 11)
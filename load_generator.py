@@ -0,0 +1,213 @@
+# =============================================================
+# load generator for server.py
+# usage:
+#   python load_generator.py --saved_model_dir synth90k_hats_export/<timestamp> \
+#       --filenames synth90k_test.tfrecord \
+#       --max_batch_sizes 1 8 32 --max_wait_ms 1 5 20 --concurrencies 1 8 32
+# a server is started for each (max_batch_size, max_wait_ms) and each concurrency is measured on it.
+# without --saved_model_dir, an already running server on --host:--port is measured
+# =============================================================
+
+import numpy as np
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+import dataset
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--saved_model_dir", type=str, default=None, help="SavedModel served by server.py (if not given, use running server)")
+parser.add_argument("--host", type=str, default="127.0.0.1", help="host of server")
+parser.add_argument("--port", type=int, default=8080, help="port of server")
+parser.add_argument("--filenames", type=str, nargs="+", help="tfrecords whose images are sent")
+parser.add_argument("--num_images", type=int, default=1000, help="number of distinct images")
+parser.add_argument("--max_batch_sizes", type=int, nargs="+", default=[1, 8, 32], help="--max_batch_size of servers")
+parser.add_argument("--max_wait_ms", type=float, nargs="+", default=[1.0, 5.0, 20.0], help="--max_wait_ms of servers")
+parser.add_argument("--num_workers", type=int, default=2, help="--num_workers of servers")
+parser.add_argument("--cache_max_entries", type=int, default=0, help="--cache_max_entries of servers")
+parser.add_argument("--concurrencies", type=int, nargs="+", default=[1, 8, 32], help="numbers of concurrent clients")
+parser.add_argument("--num_requests", type=int, default=1000, help="number of measured requests for each concurrency")
+parser.add_argument("--num_warmup_requests", type=int, default=50, help="number of requests before measurement")
+parser.add_argument("--startup_timeout", type=float, default=300, help="seconds to wait for server")
+
+
+class Connection(object):
+    '''
+    keep-alive HTTP/1.1 connection to server.py
+    '''
+
+    def __init__(self, reader, writer, host):
+
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+
+    @classmethod
+    async def open(cls, host, port):
+
+        reader, writer = await asyncio.open_connection(host, port)
+
+        return cls(reader, writer, host)
+
+    async def request(self, method, path, body=b""):
+
+        self.writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(
+            method, path, self.host, len(body)
+        ).encode("latin-1") + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in [b"\r\n", b"\n", b""]:
+                break
+            key, value = line.decode("latin-1").split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+
+        response = json.loads(await self.reader.readexactly(int(headers["content-length"])))
+
+        if status != 200:
+            raise RuntimeError("{} {}: {} {}".format(method, path, status, response))
+
+        return response
+
+    def close(self):
+
+        self.writer.close()
+
+
+async def get_metrics(host, port):
+
+    connection = await Connection.open(host, port)
+    try:
+        return await connection.request("GET", "/metrics")
+    finally:
+        connection.close()
+
+
+async def wait_for_server(host, port, process, timeout):
+
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("server exited with code {}".format(process.returncode))
+        try:
+            return await get_metrics(host, port)
+        except OSError:
+            await asyncio.sleep(0.5)
+
+    raise RuntimeError("server did not start in {} sec".format(timeout))
+
+
+async def generate(host, port, encoded_images, concurrency, num_requests):
+    '''
+    concurrency clients send num_requests requests in total, each waiting for its previous response (closed loop).
+    returns latencies and elapsed time
+    '''
+
+    images = itertools.cycle(encoded_images)
+    counter = itertools.count()
+    latencies = []
+
+    async def client():
+
+        connection = await Connection.open(host, port)
+        try:
+            while next(counter) < num_requests:
+                begin = time.time()
+                await connection.request("POST", "/predict", next(images))
+                latencies.append(time.time() - begin)
+        finally:
+            connection.close()
+
+    begin = time.time()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+
+    return latencies, time.time() - begin
+
+
+async def measure(host, port, encoded_images, concurrencies, num_requests, num_warmup_requests):
+
+    await generate(host, port, encoded_images, max(concurrencies), num_warmup_requests)
+
+    results = []
+
+    for concurrency in concurrencies:
+
+        # サーバー側の平均バッチサイズは計測前後のカウンタの差から求める
+        metrics = await get_metrics(host, port)
+        latencies, elapsed_time = await generate(host, port, encoded_images, concurrency, num_requests)
+        new_metrics = await get_metrics(host, port)
+
+        num_batches = new_metrics["num_batches"] - metrics["num_batches"]
+        num_batched_images = new_metrics["num_batched_images"] - metrics["num_batched_images"]
+        # キャッシュから返したリクエストはバッチに含まれない
+        num_served_requests = new_metrics["num_requests"] - metrics["num_requests"]
+
+        results.append(dict(
+            concurrency=concurrency,
+            throughput=len(latencies) / elapsed_time,
+            latency_p50=np.percentile(latencies, 50),
+            latency_p99=np.percentile(latencies, 99),
+            mean_batch_size=num_batched_images / num_batches if num_batches else 0.0,
+            cache_hit_rate=1 - num_batched_images / num_served_requests if num_served_requests else 0.0
+        ))
+
+    return results
+
+
+def report(title, results):
+
+    print("==================================================")
+    print(title)
+    for result in results:
+        print("    concurrency: {:<4} throughput: {:8.1f} images/sec, latency p50: {:.3e} sec, p99: {:.3e} sec, mean batch size: {:.2f}, cache hit rate: {:.2f}".format(
+            result["concurrency"], result["throughput"], result["latency_p50"], result["latency_p99"],
+            result["mean_batch_size"], result["cache_hit_rate"]
+        ))
+
+
+async def main(args):
+
+    encoded_images = dataset.load_encoded_images(args.filenames, args.num_images)
+
+    if args.saved_model_dir is None:
+        await wait_for_server(args.host, args.port, None, args.startup_timeout)
+        results = await measure(args.host, args.port, encoded_images, args.concurrencies, args.num_requests, args.num_warmup_requests)
+        report("http://{}:{}".format(args.host, args.port), results)
+        return
+
+    for max_batch_size, max_wait_ms in itertools.product(args.max_batch_sizes, args.max_wait_ms):
+
+        process = subprocess.Popen([
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+            "--saved_model_dir", args.saved_model_dir,
+            "--host", args.host,
+            "--port", str(args.port),
+            "--max_batch_size", str(max_batch_size),
+            "--max_wait_ms", str(max_wait_ms),
+            "--num_workers", str(args.num_workers),
+            "--cache_max_entries", str(args.cache_max_entries),
+        ])
+
+        try:
+            await wait_for_server(args.host, args.port, process, args.startup_timeout)
+            results = await measure(args.host, args.port, encoded_images, args.concurrencies, args.num_requests, args.num_warmup_requests)
+        finally:
+            process.terminate()
+            process.wait()
+
+        report("max_batch_size: {}, max_wait_ms: {}, num_workers: {}".format(max_batch_size, max_wait_ms, args.num_workers), results)
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
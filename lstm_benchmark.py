@@ -0,0 +1,97 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+from networks.attention_network import static_rnn, HoistedLSTMCell
+from benchmark_utils import measure
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=100, help="batch size")
+parser.add_argument("--input_size", type=int, default=1024, help="size of flattened feature maps fed at every step")
+parser.add_argument("--num_units", type=int, default=256, help="number of lstm units")
+parser.add_argument("--sequence_length", type=int, default=24, help="sequence length (synth90k_main.py: 24)")
+parser.add_argument("--number", type=int, default=20, help="number of measured runs")
+parser.add_argument("--random_seed", type=int, default=1209, help="random seed")
+
+# AttentionNetworkのrnnと同じinitializer
+initializer = tf.initializers.variance_scaling(
+    scale=1.0,
+    mode="fan_avg",
+    distribution="untruncated_normal"
+)
+
+
+def build(implementation, inputs, args):
+    '''
+    return hidden states [sequence_length, batch_size, num_units] and gradients of their sum
+    w.r.t. inputs and lstm variables
+    '''
+
+    # 全ての実装で同じ変数(rnn/lstm_cell/kernel, rnn/lstm_cell/bias)を使う
+    with tf.variable_scope("rnn", reuse=tf.AUTO_REUSE):
+
+        if implementation == "cell":
+            cell = tf.nn.rnn_cell.LSTMCell(
+                num_units=args.num_units,
+                use_peepholes=False,
+                activation=tf.nn.tanh,
+                initializer=initializer
+            )
+            states = static_rnn(
+                cell=cell,
+                inputs=[inputs] * args.sequence_length,
+                initial_state=cell.zero_state(args.batch_size, tf.float32)
+            )
+        else:
+            cell = HoistedLSTMCell(
+                num_units=args.num_units,
+                initializer=initializer
+            )
+            step_inputs = cell.project(inputs)
+            states = static_rnn(
+                cell=cell,
+                inputs=[step_inputs] * args.sequence_length,
+                initial_state=cell.zero_state(args.batch_size, tf.float32)
+            )
+
+    outputs = tf.stack([state.h for state in states], axis=0)
+    gradients = tf.gradients(tf.reduce_sum(outputs), [inputs] + tf.trainable_variables("rnn"))
+
+    return outputs, gradients
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    np.random.seed(args.random_seed)
+    tf.set_random_seed(args.random_seed)
+
+    implementations = ["cell", "hoisted"]
+
+    with tf.Graph().as_default(), tf.device("/cpu:0"):
+
+        inputs = tf.constant(np.random.uniform(size=[args.batch_size, args.input_size]), dtype=tf.float32)
+        results = {implementation: build(implementation, inputs, args) for implementation in implementations}
+
+        with tf.Session(config=tf.ConfigProto(device_count=dict(GPU=0))) as session:
+
+            session.run(tf.global_variables_initializer())
+
+            # 変数を共有しているのでLSTMCellと同じ出力になることを確認
+            outputs, gradients = session.run(results["cell"])
+            for implementation in implementations[1:]:
+                other_outputs, other_gradients = session.run(results[implementation])
+                assert np.allclose(outputs, other_outputs, atol=1e-5), implementation
+                for gradient, other_gradient in zip(gradients, other_gradients):
+                    assert np.allclose(gradient, other_gradient, rtol=1e-4, atol=1e-4), implementation
+
+            print("[batch_size, input_size, num_units, sequence_length] = [{}, {}, {}, {}]".format(
+                args.batch_size, args.input_size, args.num_units, args.sequence_length
+            ))
+            for implementation in implementations:
+                outputs, gradients = results[implementation]
+                print("    {:<8} forward: {:.3e} sec, forward + backward: {:.3e} sec".format(
+                    implementation,
+                    measure(session, outputs, args.number),
+                    measure(session, [outputs, gradients], args.number)
+                ))
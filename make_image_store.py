@@ -0,0 +1,86 @@
+# =============================================================
+# pre-render tfrecords into memory-mapped uint8 image store
+# images are decoded and resized once (same as dataset.parse_example)
+# and served by dataset.memmap_input_fn without decoding
+#
+# synth90k:
+#   python make_image_store.py --filenames synth90k_train.tfrecord \
+#       --output_prefix synth90k_train --sequence_lengths 24 --encoding jpeg
+# multi_synth90k:
+#   python make_image_store.py --filenames multi_synth90k_train.tfrecord \
+#       --output_prefix multi_synth90k_train --sequence_lengths 5 11 --encoding jpeg
+# =============================================================
+
+import tensorflow as tf
+import numpy as np
+import argparse
+import functools
+import os
+import dataset
+from tqdm import *
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--filenames", type=str, nargs="+", help="input tfrecord filenames")
+parser.add_argument("--output_prefix", type=str, help="output image store prefix")
+parser.add_argument("--sequence_lengths", type=int, nargs="+", help="label shape (e.g. 24 for synth90k, 5 11 for multi_synth90k)")
+parser.add_argument("--encoding", type=str, default="jpeg", help="image encoding")
+parser.add_argument("--image_size", type=int, nargs=2, default=[256, 256], help="image size (height, width)")
+parser.add_argument("--batch_size", type=int, default=100, help="number of images rendered at once")
+
+
+def main(filenames, output_prefix, sequence_lengths, encoding, image_size, batch_size):
+
+    # manifestが無い場合のみrecordを数える
+    num_records = list(map(dataset.read_manifest, filenames))
+    if None in num_records:
+        num_records = [sum(1 for _ in tf.io.tf_record_iterator(filename)) for filename in filenames]
+    num_records = sum(num_records)
+
+    images_filename, labels_filename = dataset.image_store_filenames(output_prefix)
+    images = np.lib.format.open_memmap(images_filename, mode="w+", dtype=np.uint8, shape=(num_records, *image_size, 3))
+    labels = np.lib.format.open_memmap(labels_filename, mode="w+", dtype=np.int32, shape=(num_records, *sequence_lengths))
+
+    # 学習時と同じparse_exampleでdecode, resizeしてuint8のまま保存
+    next_images, next_labels = tf.data.TFRecordDataset(
+        filenames=filenames
+    ).map(
+        map_func=functools.partial(
+            dataset.parse_example,
+            sequence_lengths=sequence_lengths,
+            encoding=encoding,
+            image_size=image_size,
+            data_format="channels_last",
+            keep_uint8=True
+        ),
+        num_parallel_calls=os.cpu_count()
+    ).batch(
+        batch_size=batch_size
+    ).prefetch(
+        buffer_size=1
+    ).make_one_shot_iterator().get_next()
+
+    with tf.Session() as session:
+
+        with tqdm(total=num_records) as progress:
+
+            begin = 0
+
+            while True:
+                try:
+                    image_batch, label_batch = session.run([next_images, next_labels])
+                except tf.errors.OutOfRangeError:
+                    break
+                images[begin:begin + len(image_batch)] = image_batch
+                labels[begin:begin + len(label_batch)] = label_batch
+                begin += len(image_batch)
+                progress.update(len(image_batch))
+
+    images.flush()
+    labels.flush()
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    main(args.filenames, args.output_prefix, args.sequence_lengths, args.encoding, args.image_size, args.batch_size)
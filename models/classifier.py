@@ -7,15 +7,23 @@ from networks import ops
 
 class Classifier(object):
 
-    def __init__(self, backbone_network, num_classes, data_format, hyper_params):
+    def __init__(self, backbone_network, num_classes, data_format, hyper_params,
+                 class_names=None, prediction_outputs=("predictions",)):
 
         self.backbone_network = backbone_network
         self.num_classes = num_classes
         self.data_format = data_format
         self.hyper_params = hyper_params
+        # class id => 文字
+        self.class_names = class_names
+        # prediction modeの出力 ("predictions", "strings", "images"から選択)
+        self.prediction_outputs = prediction_outputs
 
     def __call__(self, images, labels, mode):
 
+        raw_images = images
+        images = ops.convert_images(images, self.data_format)
+
         feature_maps = self.backbone_network(
             inputs=images,
             training=mode == tf.estimator.ModeKeys.TRAIN
@@ -35,12 +43,21 @@ class Classifier(object):
 
         if mode == tf.estimator.ModeKeys.PREDICT:
 
+            outputs = dict(
+                predictions=lambda: predictions,
+                strings=lambda: tf.gather(tf.constant(self.class_names), predictions),
+                images=lambda: raw_images
+            )
+
+            unknown_outputs = set(self.prediction_outputs) - set(outputs)
+            if unknown_outputs:
+                raise ValueError("unknown prediction outputs: {}".format(sorted(unknown_outputs)))
+            if "strings" in self.prediction_outputs and self.class_names is None:
+                raise ValueError("class_names is required for strings output")
+
             return tf.estimator.EstimatorSpec(
                 mode=mode,
-                predictions=dict(
-                    images=images,
-                    predictions=predictions
-                )
+                predictions={name: outputs[name]() for name in self.prediction_outputs}
             )
 
         loss = tf.losses.sparse_softmax_cross_entropy(
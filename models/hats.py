@@ -1,17 +1,65 @@
 import tensorflow as tf
 import numpy as np
 import functools
+import os
 import metrics
 import summary
 from networks import ops
 from algorithms import *
 
 
+def spatial_flatten(inputs, data_format):
+    # 空間方向にflattenするための便利関数
+    inputs_shape = inputs.shape.as_list()
+    outputs_shape = ([-1, inputs_shape[1], np.prod(inputs_shape[2:])] if data_format == "channels_first" else
+                     [-1, np.prod(inputs_shape[1:-1]), inputs_shape[-1]])
+    return tf.reshape(inputs, outputs_shape)
+
+
+def data_format_filename(model_dir):
+
+    return os.path.join(model_dir, "data_format.txt")
+
+
+def check_data_format(model_dir, data_format):
+    """ Fails if data_format recorded in model_dir (record_data_format) differs. Nothing is written.
+    Flattened feature maps (attention network rnn input and projection) are in data_format order,
+    so checkpoints restored with another data_format load without errors and give wrong predictions.
+    Models without the record are not checked.
+    """
+
+    filename = data_format_filename(model_dir)
+
+    if not tf.gfile.Exists(filename):
+        return
+
+    with tf.gfile.GFile(filename) as f:
+        recorded_data_format = f.read().strip()
+
+    if recorded_data_format != data_format:
+        raise ValueError("checkpoints in {} are trained with {}, but data_format is {}".format(
+            model_dir, recorded_data_format, data_format
+        ))
+
+
+def record_data_format(model_dir, data_format):
+    """ Records data_format in model_dir when training starts a new model (no checkpoints in model_dir). """
+
+    if tf.train.latest_checkpoint(model_dir):
+        return
+
+    tf.gfile.MakeDirs(model_dir)
+    with tf.gfile.GFile(data_format_filename(model_dir), "w") as f:
+        f.write(data_format)
+
+
 class HATS(object):
     """ HATS: Hierarchical Attention-based Text Spotter """
 
     def __init__(self, backbone_network, attention_network,
-                 num_units, num_classes, data_format, hyper_params):
+                 num_units, num_classes, data_format, hyper_params,
+                 batched_pooling=False, stacked_heads=False, skip_absent=False, early_exit=False,
+                 class_names=None, prediction_outputs=("strings",)):
 
         self.backbone_network = backbone_network
         self.attention_network = attention_network
@@ -20,8 +68,31 @@ class HATS(object):
         self.data_format = data_format
         self.hyper_params = hyper_params
         self.blank = num_classes - 1
+        # attention mapによるfeature extractionを1回のbatched matmulで行う
+        self.batched_pooling = batched_pooling
+        # FC層とlogitを全文字分まとめて一度に計算する
+        self.stacked_heads = stacked_heads
+        # 学習・評価時はラベルに存在する単語・文字の位置だけ計算する
+        # batch normalizationの統計量が存在する位置だけから計算されるので出力は変わる
+        self.skip_absent = skip_absent
+        # 推論時はEOSを予測したサンプルをその後の計算から除外する (training=Falseのみ)
+        # EOS以降の位置はblankで埋められる
+        self.early_exit = early_exit
+        # class id => 文字 (blankは"")
+        self.class_names = class_names
+        # prediction modeの出力 ("strings", "predictions", "attention_maps", "images"から選択)
+        # attention mapsはuint8に量子化して出力する
+        self.prediction_outputs = prediction_outputs
 
     def __call__(self, images, labels, mode, params):
+        # =========================================================================================
+        # dictで渡された場合, images以外のfeature(pathsなど)はprediction modeでそのまま出力する
+        features = images if isinstance(images, dict) else dict(images=images)
+        images = features["images"]
+        # =========================================================================================
+        # uint8のまま渡された画像はここでfloatに変換
+        raw_images = images
+        images = ops.convert_images(images, self.data_format)
         # =========================================================================================
         # feature mapを計算
         feature_maps = self.backbone_network(
@@ -29,84 +100,90 @@ class HATS(object):
             training=params.training
         )
         # =========================================================================================
+        # EOSで打ち切る推論
+        if self.early_exit and mode == tf.estimator.ModeKeys.PREDICT:
+            return self.predict_until_eos(raw_images, feature_maps, params.training, features)
+        # =========================================================================================
         # attention mapを計算
         # 文字構造がnested listとして出力される
         # nested listはalgorithmsモジュール全般で処理する
-        # TODO: sequence_lengthsを渡して冗長な計算を除去
         # TODO: 若干混み合った計算が必要, 出来るだけ抽象的に描きたい
-        attention_maps = self.attention_network(
-            inputs=feature_maps,
-            training=params.training
-        )
+        skip_absent = self.skip_absent and mode != tf.estimator.ModeKeys.PREDICT
+        if skip_absent:
+            # ラベルに存在する位置(batch index, flattenされた位置)だけattention mapを計算
+            # attention mapは[num_live_positions, ...]のtensorとして出力される
+            live_mask = self.live_mask(labels)
+            live_indices = tf.cast(tf.where(live_mask), tf.int32)
+            attention_maps = self.attention_network(
+                inputs=feature_maps,
+                training=params.training,
+                indices=live_indices
+            )
+        else:
+            attention_maps = self.attention_network(
+                inputs=feature_maps,
+                training=params.training
+            )
         # =========================================================================================
-        # 空間方向にflattenするための便利関数
-
-        def spatial_flatten(inputs, data_format):
-            inputs_shape = inputs.shape.as_list()
-            outputs_shape = ([-1, inputs_shape[1], np.prod(inputs_shape[2:])] if data_format == "channels_first" else
-                             [-1, np.prod(inputs_shape[1:-1]), inputs_shape[-1]])
-            return tf.reshape(inputs, outputs_shape)
-
         # attention mapによるfeature extraction
-        feature_vectors = map_innermost_element(
-            function=lambda attention_maps: tf.layers.flatten(tf.matmul(
-                a=spatial_flatten(feature_maps, self.data_format),
-                b=spatial_flatten(attention_maps, self.data_format),
-                transpose_a=False if self.data_format == "channels_first" else True,
-                transpose_b=True if self.data_format == "channels_first" else False
-            )),
-            sequence=attention_maps
-        )
-        # =========================================================================================
-        # logitの前に何層かFCを入れておく
-        # TODO: 本当に必要?
-        for i, num_units in enumerate(self.num_units):
-
-            with tf.variable_scope("dense_block_{}".format(i)):
-
-                feature_vectors = map_innermost_element(
-                    function=compose(
-                        lambda inputs: tf.layers.dense(
-                            inputs=inputs,
-                            units=num_units,
-                            use_bias=False,
-                            kernel_initializer=tf.initializers.variance_scaling(
-                                scale=2.0,
-                                mode="fan_in",
-                                distribution="untruncated_normal"
-                            ),
-                            name="dense",
-                            reuse=tf.AUTO_REUSE
-                        ),
-                        lambda inputs: ops.batch_normalization(
-                            inputs=inputs,
-                            data_format=self.data_format,
-                            training=params.training,
-                            name="batch_normalization",
-                            reuse=tf.AUTO_REUSE
-                        ),
-                        lambda inputs: tf.nn.relu(inputs)
-                    ),
-                    sequence=feature_vectors
-                )
+        if skip_absent:
+            # 各画像の存在する位置を前に詰めて[batch_size, max_num_live_positions, ...]にscatterし，
+            # 一度にpoolingしてから存在する位置だけgatherする
+            slots = tf.gather_nd(tf.cumsum(tf.cast(live_mask, tf.int32), axis=1, exclusive=True), live_indices)
+            slot_indices = tf.stack([live_indices[:, 0], slots], axis=1)
+            packed_attention_maps = tf.scatter_nd(
+                indices=slot_indices,
+                updates=attention_maps,
+                shape=tf.concat([
+                    [tf.shape(live_mask)[0], tf.reduce_max(tf.reduce_sum(tf.cast(live_mask, tf.int32), axis=1))],
+                    tf.shape(attention_maps)[1:]
+                ], axis=0)
+            )
+            packed_attention_maps.set_shape([None, None] + attention_maps.shape.as_list()[1:])
+            feature_vectors = tf.gather_nd(self.attention_pooling(feature_maps, packed_attention_maps), slot_indices)
+        elif self.batched_pooling:
+            # [batch_size, ...] x N => [batch_size, N, ...]で一度に計算してからnested listに戻す
+            leaves, treedef = tree_flatten(attention_maps)
+            feature_vectors = treedef.unflatten(tf.unstack(
+                value=self.attention_pooling(feature_maps, tf.stack(leaves, axis=1)),
+                axis=1
+            ))
+        else:
+            flat_feature_maps = spatial_flatten(feature_maps, self.data_format)
+            feature_vectors = map_innermost_element(
+                function=lambda attention_maps: tf.layers.flatten(tf.matmul(
+                    a=flat_feature_maps,
+                    b=spatial_flatten(attention_maps, self.data_format),
+                    transpose_a=False if self.data_format == "channels_first" else True,
+                    transpose_b=True if self.data_format == "channels_first" else False
+                )),
+                sequence=attention_maps
+            )
         # =========================================================================================
-        # logitのinitializationは特に重要ではない?
-        # softmaxだからとりあえずxavier initialization
-        logits = map_innermost_element(
-            function=lambda feature_vectors: tf.layers.dense(
-                inputs=feature_vectors,
-                units=self.num_classes,
-                kernel_initializer=tf.initializers.variance_scaling(
-                    scale=1.0,
-                    mode="fan_avg",
-                    distribution="untruncated_normal"
-                ),
-                bias_initializer=tf.initializers.zeros(),
-                name="logits",
-                reuse=tf.AUTO_REUSE
-            ),
-            sequence=feature_vectors
-        )
+        # FC層とlogit
+        if skip_absent:
+            # 存在する位置だけ計算し，存在しない位置のlogitは0で埋めてnested listに戻す
+            # 存在しない位置はlossやmetricsでマスクされる
+            logits = tf.scatter_nd(
+                indices=live_indices,
+                updates=self.classify(feature_vectors, params.training),
+                shape=tf.concat([tf.shape(live_mask), [self.num_classes]], axis=0)
+            )
+            logits.set_shape(live_mask.shape.as_list() + [self.num_classes])
+            logits = self.label_structure(labels).unflatten(tf.unstack(logits, axis=1))
+        elif self.stacked_heads:
+            # 重みは共有されているので[N * batch_size, ...]にまとめて一度に計算してからnested listに戻す
+            leaves, treedef = tree_flatten(feature_vectors)
+            logits = treedef.unflatten(tf.split(
+                value=self.classify(tf.concat(leaves, axis=0), params.training, num_groups=len(leaves)),
+                num_or_size_splits=len(leaves),
+                axis=0
+            ))
+        else:
+            logits = map_innermost_element(
+                function=lambda feature_vectors: self.classify(feature_vectors, params.training),
+                sequence=feature_vectors
+            )
         # argmaxで文字予測
         predictions = map_innermost_element(
             function=lambda logits: tf.argmax(
@@ -132,14 +209,7 @@ class HATS(object):
                     sequence=predictions
                 )
 
-            return tf.estimator.EstimatorSpec(
-                mode=mode,
-                predictions=dict(
-                    images=images,
-                    attention_maps=attention_maps,
-                    predictions=predictions
-                )
-            )
+            return self.prediction_spec(raw_images, attention_maps, predictions, features)
         # =========================================================================================
         # logits, predictions同様にlabelsもunstackしてnested listにしておく
         while all(flatten_innermost_element(map_innermost_element(lambda labels: len(labels.shape) > 1, labels))):
@@ -211,6 +281,20 @@ class HATS(object):
             ),
             sequence=attention_maps
         )
+        if skip_absent:
+            # summaryに使う先頭の画像についてだけnested listに戻す
+            max_outputs = 2
+            head = tf.where(tf.less(live_indices[:, 0], max_outputs))[:, 0]
+            attention_maps = tf.scatter_nd(
+                indices=tf.gather(live_indices, head),
+                updates=tf.gather(attention_maps, head),
+                shape=tf.concat([
+                    [tf.minimum(tf.shape(live_mask)[0], max_outputs), tf.shape(live_mask)[1]],
+                    tf.shape(attention_maps)[1:]
+                ], axis=0)
+            )
+            attention_maps.set_shape([None] + live_mask.shape.as_list()[1:] + attention_maps.shape.as_list()[1:])
+            attention_maps = self.label_structure(labels).unflatten(tf.unstack(attention_maps, axis=1))
         # =========================================================================================
         # tensorboard用のsummary
         summary.scalar(word_accuracy, name="word_accuracy")
@@ -253,3 +337,215 @@ class HATS(object):
                 )
             )
         # =========================================================================================
+
+    def predict_until_eos(self, images, feature_maps, training, features=None):
+        """ Prediction mode with early exit (AttentionNetwork.decode_until_eos).
+        Predictions are same as the ordinary prediction mode up to the first EOS of each word and the first empty word.
+        """
+
+        scope = tf.get_variable_scope()
+
+        def readout(attention_maps, indices):
+            # attention network内のloopから呼ばれるので元のvariable scopeに戻す
+            with tf.variable_scope(scope, auxiliary_name_scope=False):
+                feature_vectors = self.attention_pooling(
+                    feature_maps=tf.gather(feature_maps, indices),
+                    attention_maps=tf.expand_dims(attention_maps, axis=1)
+                )[:, 0]
+                return tf.argmax(
+                    input=self.classify(feature_vectors, training),
+                    axis=-1,
+                    output_type=tf.int32
+                )
+
+        attention_maps, predictions = self.attention_network.decode_until_eos(
+            inputs=feature_maps,
+            training=training,
+            readout=readout,
+            eos=self.blank
+        )
+
+        return self.prediction_spec(images, attention_maps, predictions, features)
+
+    def prediction_spec(self, images, attention_maps, predictions, features=None):
+        """ EstimatorSpec of prediction mode with outputs selected by prediction_outputs.
+        features other than images are forwarded to outputs.
+        attention_maps: [batch_size, sequence_length_0, ..., C, H, W] (channels_first) or [..., H, W, C] (channels_last)
+        predictions: [batch_size, sequence_length_0, ...]
+        """
+
+        outputs = dict(
+            strings=lambda: self.decode_strings(predictions),
+            predictions=lambda: predictions,
+            # sigmoidの出力なので[0, 1] => [0, 255]
+            attention_maps=lambda: tf.cast(tf.round(tf.clip_by_value(attention_maps, 0.0, 1.0) * 255.0), tf.uint8),
+            images=lambda: images
+        )
+
+        unknown_outputs = set(self.prediction_outputs) - set(outputs)
+        if unknown_outputs:
+            raise ValueError("unknown prediction outputs: {}".format(sorted(unknown_outputs)))
+
+        predictions = {name: outputs[name]() for name in self.prediction_outputs}
+        predictions.update({name: feature for name, feature in (features or {}).items() if name != "images"})
+
+        return tf.estimator.EstimatorSpec(
+            mode=tf.estimator.ModeKeys.PREDICT,
+            predictions=predictions
+        )
+
+    def decode_strings(self, predictions):
+        """ Decodes predictions [batch_size, sequence_length_0, ...] to strings [batch_size] ("word1_word2_...").
+        Characters after the first blank (EOS) of each word and words after the first empty word are dropped.
+        """
+
+        if self.class_names is None:
+            raise ValueError("class_names is required for strings output")
+
+        strings = tf.gather(tf.constant(self.class_names), predictions)
+        # 内側のレベルから順に結合する (文字は区切りなし, 単語は"_"区切り)
+        for separator in [""] + ["_"] * (len(predictions.shape) - 2):
+            valid = tf.cast(tf.cumprod(tf.cast(tf.not_equal(strings, ""), tf.int32), axis=-1), tf.bool)
+            separators = tf.where(
+                condition=tf.logical_and(valid, tf.not_equal(tf.cumsum(tf.cast(valid, tf.int32), axis=-1), 1)),
+                x=tf.fill(tf.shape(strings), separator),
+                y=tf.fill(tf.shape(strings), "")
+            )
+            strings = tf.where(valid, tf.strings.join([separators, strings]), tf.fill(tf.shape(strings), ""))
+            strings = tf.strings.reduce_join(strings, axis=-1)
+
+        return strings
+
+    def live_mask(self, labels):
+        """ Positions which are decoded in training.
+        labels: [batch_size, max_sequence_length_0, ..., max_sequence_length_N]
+        returns boolean mask of shape [batch_size, max_sequence_length_0 * ... * max_sequence_length_N]
+        where characters up to the first blank (EOS) of existing words are True.
+        """
+
+        label_lengths = tf.count_nonzero(tf.not_equal(labels, self.blank), axis=-1, dtype=tf.int32)
+        # 最初のblankはEOSとして残しておく, blankのみ含む単語は存在しない
+        live_mask = tf.logical_and(
+            x=tf.sequence_mask(label_lengths + 1, labels.shape[-1]),
+            y=tf.expand_dims(tf.greater(label_lengths, 0), axis=-1)
+        )
+
+        return tf.reshape(live_mask, [-1, np.prod(labels.shape.as_list()[1:])])
+
+    def label_structure(self, labels):
+        """ TreeDef of nested list of shape labels.shape[1:] (same as attention maps of AttentionNetwork). """
+
+        return tree_structure(functools.reduce(
+            lambda structure, sequence_length: [structure] * sequence_length,
+            reversed(labels.shape.as_list()[1:]),
+            None
+        ))
+
+    def classify(self, feature_vectors, training, num_groups=None):
+        """ Dense blocks and logits.
+        feature_vectors: [batch_size, D], or [num_groups * batch_size, D] (group-major) if num_groups is given.
+        For grouped inputs, batch normalization statistics are computed for each group (ops.grouped_batch_normalization)
+        so that outputs are identical to applying this to each group separately,
+        and moving statistics are updated as if by each group in order.
+        """
+        # =========================================================================================
+        # logitの前に何層かFCを入れておく
+        # TODO: 本当に必要?
+        for i, num_units in enumerate(self.num_units):
+
+            with tf.variable_scope("dense_block_{}".format(i)):
+
+                feature_vectors = tf.layers.dense(
+                    inputs=feature_vectors,
+                    units=num_units,
+                    use_bias=False,
+                    kernel_initializer=tf.initializers.variance_scaling(
+                        scale=2.0,
+                        mode="fan_in",
+                        distribution="untruncated_normal"
+                    ),
+                    name="dense",
+                    reuse=tf.AUTO_REUSE
+                )
+
+                if num_groups:
+                    feature_vectors = ops.grouped_batch_normalization(
+                        inputs=feature_vectors,
+                        num_groups=num_groups,
+                        data_format=self.data_format,
+                        training=training,
+                        name="batch_normalization",
+                        reuse=tf.AUTO_REUSE
+                    )
+                else:
+                    feature_vectors = ops.batch_normalization(
+                        inputs=feature_vectors,
+                        data_format=self.data_format,
+                        training=training,
+                        name="batch_normalization",
+                        reuse=tf.AUTO_REUSE
+                    )
+
+                feature_vectors = tf.nn.relu(feature_vectors)
+        # =========================================================================================
+        # logitのinitializationは特に重要ではない?
+        # softmaxだからとりあえずxavier initialization
+        logits = tf.layers.dense(
+            inputs=feature_vectors,
+            units=self.num_classes,
+            kernel_initializer=tf.initializers.variance_scaling(
+                scale=1.0,
+                mode="fan_avg",
+                distribution="untruncated_normal"
+            ),
+            bias_initializer=tf.initializers.zeros(),
+            name="logits",
+            reuse=tf.AUTO_REUSE
+        )
+
+        return logits
+
+    def attention_pooling(self, feature_maps, attention_maps):
+        """ Feature extraction by all attention maps in a single contraction.
+        feature_maps: [batch_size, C', H, W] (channels_first) or [batch_size, H, W, C'] (channels_last)
+        attention_maps: [batch_size, N, C, H, W] (channels_first) or [batch_size, N, H, W, C] (channels_last)
+        returns feature vectors of shape [batch_size, N, C' * C], same as per-attention-map matmul
+        """
+
+        feature_maps_shape = feature_maps.shape.as_list()
+        attention_maps_shape = attention_maps.shape.as_list()
+        # Nは動的でもよい
+        attention_maps_shape[1] = attention_maps_shape[1] or tf.shape(attention_maps)[1]
+
+        if self.data_format == "channels_first":
+            num_maps, channels = attention_maps_shape[1:3]
+            feature_channels = feature_maps_shape[1]
+            # [batch_size, N * C, HW] x [batch_size, C', HW]^T => [batch_size, N * C, C']
+            # channels_firstならattention mapのtransposeは不要
+            feature_vectors = tf.matmul(
+                a=tf.reshape(attention_maps, [-1, num_maps * channels, np.prod(attention_maps_shape[3:])]),
+                b=spatial_flatten(feature_maps, self.data_format),
+                transpose_b=True
+            )
+            # [batch_size, N, C, C'] => [batch_size, N, C', C]
+            feature_vectors = tf.reshape(feature_vectors, [-1, num_maps, channels, feature_channels])
+            feature_vectors = tf.transpose(feature_vectors, [0, 1, 3, 2])
+        else:
+            num_maps, channels = attention_maps_shape[1], attention_maps_shape[-1]
+            feature_channels = feature_maps_shape[-1]
+            spatial_size = np.prod(attention_maps_shape[2:-1])
+            # [batch_size, N, HW, C] => [batch_size, HW, N * C]
+            attention_maps = tf.reshape(attention_maps, [-1, num_maps, spatial_size, channels])
+            attention_maps = tf.transpose(attention_maps, [0, 2, 1, 3])
+            attention_maps = tf.reshape(attention_maps, [-1, spatial_size, num_maps * channels])
+            # [batch_size, HW, C']^T x [batch_size, HW, N * C] => [batch_size, C', N * C]
+            feature_vectors = tf.matmul(
+                a=spatial_flatten(feature_maps, self.data_format),
+                b=attention_maps,
+                transpose_a=True
+            )
+            # [batch_size, C', N, C] => [batch_size, N, C', C]
+            feature_vectors = tf.reshape(feature_vectors, [-1, feature_channels, num_maps, channels])
+            feature_vectors = tf.transpose(feature_vectors, [0, 2, 1, 3])
+
+        return tf.reshape(feature_vectors, [-1, num_maps, feature_channels * channels])
@@ -22,7 +22,9 @@ import functools
 import itertools
 import dataset
 import hooks
-from models.hats import HATS
+import inference
+from convert_dataset import class_ids
+from models.hats import HATS, check_data_format, record_data_format
 from networks.attention_network import AttentionNetwork
 from networks.pyramid_resnet import PyramidResNet
 from attrdict import AttrDict as Param
@@ -42,14 +44,32 @@ parser.add_argument("--steps", type=int, default=None, help="number of test step
 parser.add_argument('--train', action="store_true", help="with training")
 parser.add_argument('--eval', action="store_true", help="with evaluation")
 parser.add_argument('--predict', action="store_true", help="with prediction")
+parser.add_argument('--predict_filenames', type=str, nargs="+", default=["multi_synth90k_test.tfrecord"], help="tfrecords, image files or directories of images (glob patterns) for prediction")
+parser.add_argument("--predict_output", type=str, default="multi_synth90k_predictions", help="prefix of compressed prediction shards (\"<prefix>-00000.npz\", ...)")
+parser.add_argument("--num_processes", type=int, default=1, help="number of prediction processes")
+parser.add_argument('--export', action="store_true", help="export SavedModel for serving")
+parser.add_argument('--export_numeric', action="store_true", help="export with uint8 image input and class id outputs (for quantize_model.py)")
+parser.add_argument("--export_dir", type=str, default="multi_synth90k_hats_export", help="base directory of exported SavedModels")
+parser.add_argument('--attention_maps', action="store_true", help="output uint8 attention maps in prediction and export")
+parser.add_argument('--keep_uint8', action="store_true", help="keep images uint8 in input pipeline")
+parser.add_argument("--pipeline_config", type=str, default=None, help="input pipeline config written by dataset_benchmark.py")
+parser.add_argument("--image_store", type=str, default=None, help="prefix of image store made by make_image_store.py (used for training instead of train_filenames)")
+parser.add_argument('--skip_absent', action="store_true", help="decode only words and characters present in labels in training and evaluation")
 parser.add_argument("--gpu", type=str, default="0", help="gpu id")
 args = parser.parse_args()
 
+# prediction processesはforkされるので，同じprocessでtensorflowのsessionを実行した後には使えない
+if args.predict and args.num_processes > 1 and (args.train or args.eval):
+    parser.error("--num_processes > 1 cannot be used with --train or --eval (run --predict separately)")
+
 tf.logging.set_verbosity(tf.logging.INFO)
 
 
 if __name__ == "__main__":
 
+    # checkpointと異なるdata_formatで復元すると，エラーなしで誤った予測になるので止める
+    check_data_format(args.model_dir, args.data_format)
+
     # validation時のbatch normalizationの統計は
     # ミニバッチの統計か移動統計どちらを使用するべき？
     # ミニバッチの統計を使う場合に備えてEstimatorのparams以外を一度固定
@@ -85,7 +105,11 @@ if __name__ == "__main__":
                     Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
                     Param(filters=16, kernel_size=[3, 3], strides=[2, 2]),
                 ],
-                data_format=args.data_format
+                data_format=args.data_format,
+                # 計算方法の切り替え (出力もbatch normalizationの移動統計も変わらない)
+                hoisted_lstm=True,
+                batched_levels=True,
+                batched_deconv=True
             ),
             # =========================================================================================
             # text recognition
@@ -102,7 +126,20 @@ if __name__ == "__main__":
                     decay_rate=1e-1,
                     staircase=True
                 )
-            )
+            ),
+            # =========================================================================================
+            # 計算方法の切り替え (出力もbatch normalizationの移動統計も変わらない)
+            batched_pooling=True,
+            stacked_heads=True,
+            # 存在しない単語・文字の計算を省略 (batch normalizationの統計量が変わる)
+            skip_absent=args.skip_absent,
+            # 推論時はEOSで打ち切る (文字列の出力は変わらない)
+            # while loopはtfliteに変換できないので--export_numericでは使わない
+            early_exit=not args.export_numeric,
+            # =========================================================================================
+            # prediction modeの出力
+            class_names=sorted(class_ids, key=class_ids.get),
+            prediction_outputs=(["predictions"] if args.export_numeric else ["strings"]) + (["attention_maps"] if args.attention_maps else [])
         )(features, labels, mode, Param(params)),
         model_dir=args.model_dir,
         config=tf.estimator.RunConfig(
@@ -125,8 +162,19 @@ if __name__ == "__main__":
 
     if args.train:
 
+        record_data_format(args.model_dir, args.data_format)
+
         Estimator(params=dict(training=True)).train(
+            # image storeがあればdecodeとresizeを省略して読み込む
             input_fn=functools.partial(
+                dataset.memmap_input_fn,
+                filename_prefix=args.image_store,
+                batch_size=args.batch_size,
+                num_epochs=None,
+                shuffle=True,
+                data_format=args.data_format,
+                keep_uint8=args.keep_uint8
+            ) if args.image_store else functools.partial(
                 dataset.input_fn,
                 filenames=args.train_filenames,
                 batch_size=args.batch_size,
@@ -135,7 +183,9 @@ if __name__ == "__main__":
                 sequence_lengths=[5, 11],
                 encoding="jpeg",
                 image_size=[256, 256],
-                data_format=args.data_format
+                data_format=args.data_format,
+                keep_uint8=args.keep_uint8,
+                pipeline_config=args.pipeline_config
             ),
             max_steps=args.max_steps,
             hooks=[
@@ -160,7 +210,9 @@ if __name__ == "__main__":
                         sequence_lengths=[5, 11],
                         encoding="jpeg",
                         image_size=[256, 256],
-                        data_format=args.data_format
+                        data_format=args.data_format,
+                        keep_uint8=args.keep_uint8,
+                        pipeline_config=args.pipeline_config
                     ),
                     every_n_steps=1000,
                     steps=1000,
@@ -181,7 +233,9 @@ if __name__ == "__main__":
                 sequence_lengths=[5, 11],
                 encoding="jpeg",
                 image_size=[256, 256],
-                data_format=args.data_format
+                data_format=args.data_format,
+                keep_uint8=args.keep_uint8,
+                pipeline_config=args.pipeline_config
             ),
             steps=args.steps,
             name="test"
@@ -191,3 +245,38 @@ if __name__ == "__main__":
         tf.logging.info("test result")
         tf.logging.info(eval_result)
         print("==================================================")
+
+    if args.predict:
+
+        # 推論時はbatch normalizationに移動統計を使う
+        inference.run(
+            estimator_fn=lambda: Estimator(params=dict(training=False)),
+            input_fn=functools.partial(
+                dataset.predict_input_fn,
+                filenames=inference.expand_filenames(args.predict_filenames),
+                batch_size=args.batch_size,
+                encoding="jpeg",
+                image_size=[256, 256],
+                data_format=args.data_format,
+                keep_uint8=args.keep_uint8
+            ),
+            output_filename_prefix=args.predict_output,
+            num_processes=args.num_processes
+        )
+
+    if args.export:
+
+        # 画像のdecodeとresizeを含むserving用のgraph (prediction modeのみ)
+        export_dir = Estimator(params=dict(training=False)).export_saved_model(
+            export_dir_base=args.export_dir,
+            serving_input_receiver_fn=functools.partial(
+                dataset.image_serving_input_receiver_fn,
+                image_size=[256, 256]
+            ) if args.export_numeric else functools.partial(
+                dataset.serving_input_receiver_fn,
+                encoding="jpeg",
+                image_size=[256, 256]
+            )
+        )
+
+        print("SavedModel exported to {}".format(export_dir.decode("utf-8")))
@@ -1,5 +1,6 @@
 import tensorflow as tf
 import numpy as np
+import functools
 import os
 from . import ops
 from algorithms import *
@@ -11,193 +12,524 @@ def static_rnn(cell, inputs, initial_state):
     return list(accumulate([initial_state] + inputs, lambda state, inputs: cell(inputs, state)[1]))[1:]
 
 
+class HoistedLSTMCell(object):
+    """ LSTM cell whose input projection is computed once by project() and reused at every step.
+    Variables (lstm_cell/kernel, lstm_cell/bias) and gates (i, j, f, o) are same as tf.nn.rnn_cell.LSTMCell,
+    so checkpoints of LSTMCell can be loaded.
+    """
+
+    def __init__(self, num_units, initializer, forget_bias=1.0, name="lstm_cell"):
+
+        self.num_units = num_units
+        self.initializer = initializer
+        self.forget_bias = forget_bias
+        self.name = name
+        self.kernel = None
+        self.bias = None
+
+    def build(self, input_size):
+
+        if self.kernel is None:
+
+            with tf.variable_scope(self.name, reuse=tf.AUTO_REUSE):
+
+                self.kernel = tf.get_variable(
+                    name="kernel",
+                    shape=[input_size + self.num_units, self.num_units * 4],
+                    initializer=self.initializer
+                )
+                self.bias = tf.get_variable(
+                    name="bias",
+                    shape=[self.num_units * 4],
+                    initializer=tf.zeros_initializer()
+                )
+
+            self.input_size = input_size
+
+    @property
+    def input_kernel(self):
+
+        return self.kernel[:self.input_size]
+
+    @property
+    def recurrent_kernel(self):
+
+        return self.kernel[self.input_size:]
+
+    def project(self, inputs):
+        """ Input projection (inputs W_x + b). Variables are created in the current variable scope. """
+
+        self.build(inputs.shape[-1].value)
+
+        return tf.matmul(inputs, self.input_kernel) + self.bias
+
+    def zero_state(self, batch_size, dtype):
+
+        return tf.nn.rnn_cell.LSTMStateTuple(
+            c=tf.zeros([batch_size, self.num_units], dtype=dtype),
+            h=tf.zeros([batch_size, self.num_units], dtype=dtype)
+        )
+
+    def __call__(self, inputs, state):
+
+        gates = inputs + tf.matmul(state.h, self.recurrent_kernel)
+        i, j, f, o = tf.split(gates, num_or_size_splits=4, axis=1)
+
+        c = state.c * tf.nn.sigmoid(f + self.forget_bias) + tf.nn.sigmoid(i) * tf.nn.tanh(j)
+        h = tf.nn.tanh(c) * tf.nn.sigmoid(o)
+
+        return h, tf.nn.rnn_cell.LSTMStateTuple(c=c, h=h)
+
+
 class AttentionNetwork(object):
 
-    def __init__(self, conv_params, rnn_params, deconv_params, data_format):
+    def __init__(self, conv_params, rnn_params, deconv_params, data_format,
+                 hoisted_lstm=False, batched_levels=False, batched_deconv=False):
 
         self.conv_params = conv_params
         self.rnn_params = rnn_params
         self.deconv_params = deconv_params
         self.data_format = data_format
+        # 全stepで同じ入力なのでinput projectionを一度だけ計算する (HoistedLSTMCell)
+        self.hoisted_lstm = hoisted_lstm
+        # 上位のレベルの各stateから始まる系列をバッチ方向にまとめて一度にunrollする
+        self.batched_levels = batched_levels
+        # 全attention mapのprojectionとdeconvolutionをバッチ方向にまとめて一度に計算する
+        # batch normalizationの統計量は位置ごとに計算され，移動統計も位置の順に更新されるので出力は変わらない
+        self.batched_deconv = batched_deconv
 
-    def __call__(self, inputs, training, name="attention_network", reuse=None):
+    def __call__(self, inputs, training, indices=None, name="attention_network", reuse=None):
+        """ Returns attention maps as nested list of shape rnn_params[*].sequence_length.
+        If indices ([K, 2] of (batch index, flattened position)) is given,
+        attention maps are computed only for those positions and returned as a tensor of K maps.
+        """
 
         with tf.variable_scope(name, reuse=reuse):
 
-            for i, conv_param in enumerate(self.conv_params):
-
-                with tf.variable_scope("conv_block_{}".format(i)):
-
-                    inputs = compose(
-                        lambda inputs: tf.layers.conv2d(
-                            inputs=inputs,
-                            filters=conv_param.filters,
-                            kernel_size=conv_param.kernel_size,
-                            strides=conv_param.strides,
-                            padding="same",
-                            data_format=self.data_format,
-                            use_bias=False,
-                            kernel_initializer=tf.initializers.variance_scaling(
-                                scale=2.0,
-                                mode="fan_in",
-                                distribution="untruncated_normal"
-                            ),
-                            name="conv2d",
-                            reuse=None
-                        ),
-                        lambda inputs: ops.batch_normalization(
-                            inputs=inputs,
-                            data_format=self.data_format,
-                            training=training,
-                            name="batch_normalization",
-                            reuse=None
-                        ),
-                        lambda inputs: tf.nn.relu(inputs)
-                    )(inputs)
+            feature_maps, image_shape = self.encode(inputs, training)
 
-            image_shape = inputs.shape.as_list()
+            if self.batched_levels:
 
-            inputs = tf.layers.flatten(inputs)
+                inputs = self.batched_rnn(feature_maps)
 
-            feature_maps = inputs
+            else:
 
-            for i, rnn_param in enumerate(self.rnn_params):
+                inputs = None
 
-                with tf.variable_scope("rnn_block_{}".format(i)):
+                for i, rnn_param in enumerate(self.rnn_params):
 
-                    lstm_cell = tf.nn.rnn_cell.LSTMCell(
-                        num_units=rnn_param.num_units,
-                        use_peepholes=False,
-                        activation=tf.nn.tanh,
-                        initializer=tf.initializers.variance_scaling(
-                            scale=1.0,
-                            mode="fan_avg",
-                            distribution="untruncated_normal"
-                        )
-                    )
+                    with tf.variable_scope("rnn_block_{}".format(i)):
+
+                        lstm_cell = self.rnn_cell(rnn_param)
 
-                    inputs = map_innermost_element(
-                        function=lambda inputs: static_rnn(
-                            cell=lstm_cell,
-                            inputs=[feature_maps] * rnn_param.sequence_length,
-                            initial_state=tf.nn.rnn_cell.LSTMStateTuple(
-                                c=tf.layers.dense(
-                                    inputs=inputs.c,
-                                    units=rnn_param.num_units,
-                                    activation=tf.nn.tanh,
-                                    kernel_initializer=tf.initializers.identity(),
-                                    bias_initializer=tf.initializers.zeros(),
-                                    name="c_projection",
-                                    reuse=tf.AUTO_REUSE
-                                ),
-                                h=tf.layers.dense(
-                                    inputs=inputs.h,
-                                    units=rnn_param.num_units,
-                                    activation=tf.nn.tanh,
-                                    kernel_initializer=tf.initializers.identity(),
-                                    bias_initializer=tf.initializers.zeros(),
-                                    name="h_projection",
-                                    reuse=tf.AUTO_REUSE
-                                )
-                            ) if i else lstm_cell.zero_state(
-                                batch_size=tf.shape(feature_maps)[0],
-                                dtype=tf.float32
+                        step_inputs = lstm_cell.project(feature_maps) if self.hoisted_lstm else feature_maps
+
+                        inputs = map_innermost_element(
+                            function=lambda inputs: static_rnn(
+                                cell=lstm_cell,
+                                inputs=[step_inputs] * rnn_param.sequence_length,
+                                initial_state=self.initial_state(i, rnn_param, lstm_cell, inputs, tf.shape(feature_maps)[0])
                             ),
+                            sequence=inputs
+                        )
 
-                        ),
-                        sequence=inputs
+            # 学習時はラベルに存在する位置(indices)だけattention mapを計算する
+            if indices is not None:
+                inputs = tf.stack([inputs.h for inputs in flatten_innermost_element(inputs)], axis=1)
+                inputs = tf.gather_nd(inputs, indices)
+                inputs = self.decode(inputs, image_shape, training)
+            elif self.batched_deconv:
+                # [batch_size, ...] x N => [N * batch_size, ...]で一度に計算してからnested listに戻す
+                leaves, treedef = tree_flatten(inputs)
+                inputs = treedef.unflatten(tf.split(
+                    value=self.decode(tf.concat([leaf.h for leaf in leaves], axis=0), image_shape, training, num_groups=len(leaves)),
+                    num_or_size_splits=len(leaves),
+                    axis=0
+                ))
+            else:
+                inputs = map_innermost_element(
+                    function=lambda inputs: self.decode(inputs.h, image_shape, training),
+                    sequence=inputs
+                )
+
+            return inputs
+
+    def batched_rnn(self, feature_maps):
+        """ Same rnn states as the nested unroll of __call__.
+        Sequences of each level are folded into batch dimension ([num_sequences * batch_size, ...], sequence-major)
+        and unrolled once per level, then unfolded to nested list of shape rnn_params[*].sequence_length.
+        Must be called in the variable scope of __call__.
+        """
+
+        states = None
+        num_sequences = 1
+
+        for i, rnn_param in enumerate(self.rnn_params):
+
+            with tf.variable_scope("rnn_block_{}".format(i)):
+
+                lstm_cell = self.rnn_cell(rnn_param)
+
+                step_inputs = lstm_cell.project(feature_maps) if self.hoisted_lstm else feature_maps
+                # 入力は全ての系列で共通
+                step_inputs = tf.tile(step_inputs, [num_sequences, 1])
+
+                states = static_rnn(
+                    cell=lstm_cell,
+                    inputs=[step_inputs] * rnn_param.sequence_length,
+                    initial_state=self.initial_state(i, rnn_param, lstm_cell, states, tf.shape(feature_maps)[0])
+                )
+
+                # [num_sequences * batch_size, ...] x sequence_length => [num_sequences * sequence_length * batch_size, ...]
+                states = tf.nn.rnn_cell.LSTMStateTuple(*[
+                    tf.reshape(tf.stack([
+                        tf.reshape(state, [num_sequences, -1, rnn_param.num_units])
+                        for state in step_states
+                    ], axis=1), [-1, rnn_param.num_units])
+                    for step_states in zip(*states)
+                ])
+
+                num_sequences *= rnn_param.sequence_length
+
+        structure = tree_structure(functools.reduce(
+            lambda structure, rnn_param: [structure] * rnn_param.sequence_length,
+            reversed(self.rnn_params),
+            None
+        ))
+
+        return structure.unflatten([
+            tf.nn.rnn_cell.LSTMStateTuple(c=c, h=h)
+            for c, h in zip(*[tf.split(state, num_sequences, axis=0) for state in states])
+        ])
+
+    def decode_until_eos(self, inputs, training, readout, eos, name="attention_network", reuse=None):
+        """ Inference with early exit.
+        readout(attention_maps, indices) returns predictions (int32) of attention maps [M, C, H, W]
+        for images of batch indices [M].
+        Each level is decoded by tf.while_loop and samples which predicted eos
+        (an empty sequence for upper levels) are removed from the remaining steps.
+        Returns attention maps [batch_size, sequence_length_0, ..., C, H, W] and predictions [batch_size, sequence_length_0, ...].
+        Positions after eos are filled with 0 and eos respectively, otherwise same as __call__.
+        Batch normalization must be in inference mode (training=False) so that outputs don't depend on batch.
+        """
+
+        if training:
+            raise ValueError("decode_until_eos is valid only for training=False")
+
+        with tf.variable_scope(name, reuse=reuse):
+
+            feature_maps, image_shape = self.encode(inputs, training)
+
+            attention_maps, predictions = self.decode_level(
+                level=0,
+                feature_maps=feature_maps,
+                indices=tf.range(tf.shape(feature_maps)[0]),
+                state=None,
+                image_shape=image_shape,
+                training=training,
+                readout=readout,
+                eos=eos,
+                scope=tf.get_variable_scope()
+            )
+
+            return attention_maps, predictions
+
+    def decode_level(self, level, feature_maps, indices, state, image_shape, training, readout, eos, scope):
+        """ Decodes sequences of rnn_params[level] for each row of feature_maps.
+        state is the rnn state of the upper level (None for level 0).
+        """
+
+        rnn_param = self.rnn_params[level]
+        batch_size = tf.shape(feature_maps)[0]
+
+        with tf.variable_scope("rnn_block_{}".format(level)):
+
+            lstm_cell = self.rnn_cell(rnn_param)
+            initial_state = self.initial_state(level, rnn_param, lstm_cell, state, batch_size)
+            step_inputs = lstm_cell.project(feature_maps) if self.hoisted_lstm else feature_maps
+
+        def cond(step, alive, state, *_):
+
+            return tf.logical_and(tf.less(step, rnn_param.sequence_length), tf.greater(tf.size(alive), 0))
+
+        def body(step, alive, state, attention_maps_array, predictions_array):
+
+            with tf.variable_scope(scope, auxiliary_name_scope=False):
+
+                with tf.variable_scope("rnn_block_{}".format(level)):
+
+                    state = lstm_cell(tf.gather(step_inputs, alive), state)[1]
+
+                if level == len(self.rnn_params) - 1:
+                    attention_maps = self.decode(state.h, image_shape, training)
+                    predictions = readout(attention_maps, tf.gather(indices, alive))
+                else:
+                    attention_maps, predictions = self.decode_level(
+                        level=level + 1,
+                        feature_maps=tf.gather(feature_maps, alive),
+                        indices=tf.gather(indices, alive),
+                        state=state,
+                        image_shape=image_shape,
+                        training=training,
+                        readout=readout,
+                        eos=eos,
+                        scope=scope
                     )
 
-            with tf.variable_scope("projection_block"):
+            # 終了したサンプルの位置は0(attention map)とeos(prediction)で埋める
+            attention_maps_array = attention_maps_array.write(step, tf.scatter_nd(
+                indices=tf.expand_dims(alive, axis=-1),
+                updates=attention_maps,
+                shape=tf.concat([[batch_size], tf.shape(attention_maps)[1:]], axis=0)
+            ))
+            predictions_array = predictions_array.write(step, tf.scatter_nd(
+                indices=tf.expand_dims(alive, axis=-1),
+                updates=predictions - eos,
+                shape=tf.concat([[batch_size], tf.shape(predictions)[1:]], axis=0)
+            ) + eos)
 
-                inputs = map_innermost_element(
-                    function=lambda inputs: tf.layers.dense(
-                        inputs=inputs.h,
-                        units=np.prod(image_shape[1:]),
-                        activation=tf.nn.relu,
+            # eosを予測したサンプル(上位のレベルでは空のsequence)を取り除く
+            finished = tf.equal(tf.reshape(predictions, [tf.shape(predictions)[0], -1])[:, 0], eos)
+            alive = tf.boolean_mask(alive, tf.logical_not(finished))
+            state = tf.nn.rnn_cell.LSTMStateTuple(
+                c=tf.boolean_mask(state.c, tf.logical_not(finished)),
+                h=tf.boolean_mask(state.h, tf.logical_not(finished))
+            )
+
+            return step + 1, alive, state, attention_maps_array, predictions_array
+
+        steps, _, _, attention_maps_array, predictions_array = tf.while_loop(
+            cond=cond,
+            body=body,
+            loop_vars=(
+                tf.constant(0),
+                tf.range(batch_size),
+                initial_state,
+                tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True),
+                tf.TensorArray(dtype=tf.int32, size=0, dynamic_size=True)
+            ),
+            shape_invariants=(
+                tf.TensorShape([]),
+                tf.TensorShape([None]),
+                tf.nn.rnn_cell.LSTMStateTuple(
+                    c=tf.TensorShape([None, rnn_param.num_units]),
+                    h=tf.TensorShape([None, rnn_param.num_units])
+                ),
+                tf.TensorShape(None),
+                tf.TensorShape(None)
+            )
+        )
+
+        # 実行されなかったstepを埋めて[batch_size, sequence_length, ...]にする
+        def pad_steps(outputs, value):
+
+            outputs = tf.pad(
+                tensor=outputs,
+                paddings=tf.concat([[[0, rnn_param.sequence_length - steps]], tf.zeros([tf.rank(outputs) - 1, 2], tf.int32)], axis=0),
+                constant_values=value
+            )
+
+            return tf.transpose(outputs, tf.concat([[1, 0], tf.range(2, tf.rank(outputs))], axis=0))
+
+        attention_maps = pad_steps(attention_maps_array.stack(), 0.0)
+        predictions = pad_steps(predictions_array.stack(), eos)
+
+        sequence_lengths = [rnn_param.sequence_length for rnn_param in self.rnn_params[level:]]
+        attention_maps.set_shape([None] + sequence_lengths + image_shape[1:])
+        predictions.set_shape([None] + sequence_lengths)
+
+        return attention_maps, predictions
+
+    def encode(self, inputs, training):
+        """ Convolutions before rnn.
+        Returns flattened feature maps and shape of feature maps (= shape of attention maps before deconvolution).
+        Must be called in the variable scope of __call__.
+        """
+
+        for i, conv_param in enumerate(self.conv_params):
+
+            with tf.variable_scope("conv_block_{}".format(i)):
+
+                inputs = compose(
+                    lambda inputs: tf.layers.conv2d(
+                        inputs=inputs,
+                        filters=conv_param.filters,
+                        kernel_size=conv_param.kernel_size,
+                        strides=conv_param.strides,
+                        padding="same",
+                        data_format=self.data_format,
+                        use_bias=False,
                         kernel_initializer=tf.initializers.variance_scaling(
                             scale=2.0,
                             mode="fan_in",
                             distribution="untruncated_normal"
                         ),
-                        bias_initializer=tf.zeros_initializer(),
-                        name="dense",
-                        reuse=tf.AUTO_REUSE
+                        name="conv2d",
+                        reuse=None
                     ),
-                    sequence=inputs
+                    lambda inputs: ops.batch_normalization(
+                        inputs=inputs,
+                        data_format=self.data_format,
+                        training=training,
+                        name="batch_normalization",
+                        reuse=None
+                    ),
+                    lambda inputs: tf.nn.relu(inputs)
+                )(inputs)
+
+        image_shape = inputs.shape.as_list()
+
+        inputs = tf.layers.flatten(inputs)
+
+        return inputs, image_shape
+
+    def rnn_cell(self, rnn_param):
+
+        if self.hoisted_lstm:
+            return HoistedLSTMCell(
+                num_units=rnn_param.num_units,
+                initializer=tf.initializers.variance_scaling(
+                    scale=1.0,
+                    mode="fan_avg",
+                    distribution="untruncated_normal"
                 )
+            )
 
-            inputs = map_innermost_element(
-                function=lambda inputs: tf.reshape(inputs, [-1] + image_shape[1:]),
-                sequence=inputs
+        return tf.nn.rnn_cell.LSTMCell(
+            num_units=rnn_param.num_units,
+            use_peepholes=False,
+            activation=tf.nn.tanh,
+            initializer=tf.initializers.variance_scaling(
+                scale=1.0,
+                mode="fan_avg",
+                distribution="untruncated_normal"
             )
+        )
 
-            for i, deconv_param in enumerate(self.deconv_params[:-1]):
-
-                with tf.variable_scope("deconv_block_{}".format(i)):
-
-                    inputs = map_innermost_element(
-                        function=compose(
-                            lambda inputs: tf.layers.conv2d_transpose(
-                                inputs=inputs,
-                                filters=deconv_param.filters,
-                                kernel_size=deconv_param.kernel_size,
-                                strides=deconv_param.strides,
-                                padding="same",
-                                data_format=self.data_format,
-                                use_bias=False,
-                                kernel_initializer=tf.initializers.variance_scaling(
-                                    scale=2.0,
-                                    mode="fan_in",
-                                    distribution="untruncated_normal"
-                                ),
-                                name="deconv2d",
-                                reuse=tf.AUTO_REUSE
-                            ),
-                            lambda inputs: ops.batch_normalization(
-                                inputs=inputs,
-                                data_format=self.data_format,
-                                training=training,
-                                name="batch_normalization",
-                                reuse=tf.AUTO_REUSE
-                            ),
-                            lambda inputs: tf.nn.relu(inputs)
+    def initial_state(self, level, rnn_param, lstm_cell, state, batch_size):
+        """ Initial state projected from the state of the upper level (zero state for level 0).
+        Must be called in the variable scope "rnn_block_{level}".
+        """
+
+        return tf.nn.rnn_cell.LSTMStateTuple(
+            c=tf.layers.dense(
+                inputs=state.c,
+                units=rnn_param.num_units,
+                activation=tf.nn.tanh,
+                kernel_initializer=tf.initializers.identity(),
+                bias_initializer=tf.initializers.zeros(),
+                name="c_projection",
+                reuse=tf.AUTO_REUSE
+            ),
+            h=tf.layers.dense(
+                inputs=state.h,
+                units=rnn_param.num_units,
+                activation=tf.nn.tanh,
+                kernel_initializer=tf.initializers.identity(),
+                bias_initializer=tf.initializers.zeros(),
+                name="h_projection",
+                reuse=tf.AUTO_REUSE
+            )
+        ) if level else lstm_cell.zero_state(
+            batch_size=batch_size,
+            dtype=tf.float32
+        )
+
+    def decode(self, inputs, image_shape, training, num_groups=None):
+        """ Projection and deconvolution from rnn hidden states to attention maps.
+        If num_groups is given, inputs are hidden states of num_groups positions concatenated along the batch axis
+        ([num_groups * batch_size, ...], group-major), and batch normalization statistics are computed for each group
+        (ops.grouped_batch_normalization). Outputs are identical to decoding each group separately,
+        and moving statistics are updated as if by each group in order.
+        Must be called in the variable scope of __call__.
+        """
+
+        with tf.variable_scope("projection_block"):
+
+            inputs = tf.layers.dense(
+                inputs=inputs,
+                units=np.prod(image_shape[1:]),
+                activation=tf.nn.relu,
+                kernel_initializer=tf.initializers.variance_scaling(
+                    scale=2.0,
+                    mode="fan_in",
+                    distribution="untruncated_normal"
+                ),
+                bias_initializer=tf.zeros_initializer(),
+                name="dense",
+                reuse=tf.AUTO_REUSE
+            )
+
+        inputs = tf.reshape(inputs, [-1] + image_shape[1:])
+
+        for i, deconv_param in enumerate(self.deconv_params[:-1]):
+
+            with tf.variable_scope("deconv_block_{}".format(i)):
+
+                inputs = compose(
+                    lambda inputs: tf.layers.conv2d_transpose(
+                        inputs=inputs,
+                        filters=deconv_param.filters,
+                        kernel_size=deconv_param.kernel_size,
+                        strides=deconv_param.strides,
+                        padding="same",
+                        data_format=self.data_format,
+                        use_bias=False,
+                        kernel_initializer=tf.initializers.variance_scaling(
+                            scale=2.0,
+                            mode="fan_in",
+                            distribution="untruncated_normal"
                         ),
-                        sequence=inputs
-                    )
+                        name="deconv2d",
+                        reuse=tf.AUTO_REUSE
+                    ),
+                    lambda inputs: self.batch_normalization(inputs, training, num_groups),
+                    lambda inputs: tf.nn.relu(inputs)
+                )(inputs)
 
-            for i, deconv_param in enumerate(self.deconv_params[-1:], i + 1):
-
-                with tf.variable_scope("deconv_block_{}".format(i)):
-
-                    inputs = map_innermost_element(
-                        function=compose(
-                            lambda inputs: tf.layers.conv2d_transpose(
-                                inputs=inputs,
-                                filters=deconv_param.filters,
-                                kernel_size=deconv_param.kernel_size,
-                                strides=deconv_param.strides,
-                                padding="same",
-                                data_format=self.data_format,
-                                use_bias=False,
-                                kernel_initializer=tf.initializers.variance_scaling(
-                                    scale=1.0,
-                                    mode="fan_avg",
-                                    distribution="untruncated_normal"
-                                ),
-                                name="deconv2d",
-                                reuse=tf.AUTO_REUSE
-                            ),
-                            lambda inputs: ops.batch_normalization(
-                                inputs=inputs,
-                                data_format=self.data_format,
-                                training=training,
-                                name="batch_normalization",
-                                reuse=tf.AUTO_REUSE
-                            ),
-                            lambda inputs: tf.nn.sigmoid(inputs)
+        for i, deconv_param in enumerate(self.deconv_params[-1:], len(self.deconv_params) - 1):
+
+            with tf.variable_scope("deconv_block_{}".format(i)):
+
+                inputs = compose(
+                    lambda inputs: tf.layers.conv2d_transpose(
+                        inputs=inputs,
+                        filters=deconv_param.filters,
+                        kernel_size=deconv_param.kernel_size,
+                        strides=deconv_param.strides,
+                        padding="same",
+                        data_format=self.data_format,
+                        use_bias=False,
+                        kernel_initializer=tf.initializers.variance_scaling(
+                            scale=1.0,
+                            mode="fan_avg",
+                            distribution="untruncated_normal"
                         ),
-                        sequence=inputs
-                    )
+                        name="deconv2d",
+                        reuse=tf.AUTO_REUSE
+                    ),
+                    lambda inputs: self.batch_normalization(inputs, training, num_groups),
+                    lambda inputs: tf.nn.sigmoid(inputs)
+                )(inputs)
 
-            return inputs
+        return inputs
+
+    def batch_normalization(self, inputs, training, num_groups=None):
+
+        if num_groups:
+            return ops.grouped_batch_normalization(
+                inputs=inputs,
+                num_groups=num_groups,
+                data_format=self.data_format,
+                training=training,
+                name="batch_normalization",
+                reuse=tf.AUTO_REUSE
+            )
+
+        return ops.batch_normalization(
+            inputs=inputs,
+            data_format=self.data_format,
+            training=training,
+            name="batch_normalization",
+            reuse=tf.AUTO_REUSE
+        )
@@ -1,19 +1,36 @@
 import tensorflow as tf
+import numpy as np
 
 
-def spatial_transformer(inputs, params, out_size, name="spatial_transformer"):
+def sampling_grid(height, width):
+    """ Regular grid of (x_t, y_t, 1) in [-1, 1] of the output, eq (1) in [1] of spatial_transformer.
+    Computed in numpy so that it is embedded in the graph as a constant of shape [3, height, width].
+    """
+
+    x_t, y_t = np.meshgrid(np.linspace(-1.0, 1.0, width), np.linspace(-1.0, 1.0, height))
+
+    return np.stack([x_t, y_t, np.ones_like(x_t)]).astype(np.float32)
+
+
+def spatial_transformer(inputs, params, out_size, data_format="channels_last", name="spatial_transformer"):
     """ Spatial Transformer Layer
     Implements a spatial transformer layer as described in [1].
     Based on [2] and edited by David Dao for Tensorflow.
+    The output grid is a constant, source coordinates are computed for the whole batch
+    by a single tensordot with it, and the four corners of bilinear sampling are looked up
+    by a single batched gather on the (reshaped) inputs in either data format.
     Parameters
     ----------
     inputs : float
         The output of a convolutional net should have the
-        shape [num_batch, height, width, num_channels].
+        shape [num_batch, height, width, num_channels] (channels_last)
+        or [num_batch, num_channels, height, width] (channels_first).
     params: float
         The output of the localisation network should be [num_batch, 6].
     out_size: tuple of two ints
         The size of the output of the network (height, width)
+    data_format: "channels_last" or "channels_first"
+        The data format of inputs and outputs
     References
     ----------
     .. [1]  Spatial Transformer Networks
@@ -29,120 +46,77 @@ def spatial_transformer(inputs, params, out_size, name="spatial_transformer"):
         params = tf.Variable(initial_value=identity)
     """
 
-    def repeat(inputs, num_repeats):
-        with tf.variable_scope("repeat"):
-            rep = tf.transpose(tf.expand_dims(tf.ones([num_repeats]), 1), [1, 0])
-            rep = tf.cast(rep, tf.int32)
-            outputs = tf.matmul(tf.reshape(inputs, [-1, 1]), rep)
-            outputs = tf.reshape(outputs, [-1])
-            return outputs
-
-    def interpolate(inputs, x, y, out_size):
-        with tf.variable_scope("interpolate"):
-            # constants
-            num_batch = tf.shape(inputs)[0]
-            height = tf.shape(inputs)[1]
-            width = tf.shape(inputs)[2]
-            num_channels = inputs.shape[3]
+    with tf.variable_scope(name):
+
+        inputs = tf.cast(inputs, tf.float32)
+        params = tf.cast(tf.reshape(params, [-1, 2, 3]), tf.float32)
 
-            x = tf.cast(x, tf.float32)
-            y = tf.cast(y, tf.float32)
-
-            # scale indices from [-1, 1] to [0, width/height]
-            x = (x + 1.0) * tf.cast(width, tf.float32) / 2.0
-            y = (y + 1.0) * tf.cast(height, tf.float32) / 2.0
-
-            # do sampling
-            x0 = tf.cast(tf.floor(x), tf.int32)
-            x1 = x0 + 1
-            y0 = tf.cast(tf.floor(y), tf.int32)
-            y1 = y0 + 1
-
-            zero = tf.zeros([], tf.int32)
-            max_y = tf.cast(tf.shape(inputs)[1] - 1, tf.int32)
-            max_x = tf.cast(tf.shape(inputs)[2] - 1, tf.int32)
-
-            x0 = tf.clip_by_value(x0, zero, max_x)
-            x1 = tf.clip_by_value(x1, zero, max_x)
-            y0 = tf.clip_by_value(y0, zero, max_y)
-            y1 = tf.clip_by_value(y1, zero, max_y)
-            dim2 = width
-            dim1 = width * height
-            base = repeat(tf.range(num_batch) * dim1, out_size[0] * out_size[1])
-            base_y0 = base + y0 * dim2
-            base_y1 = base + y1 * dim2
-            idx_a = base_y0 + x0
-            idx_b = base_y1 + x0
-            idx_c = base_y0 + x1
-            idx_d = base_y1 + x1
-
-            # use indices to lookup pixels in the flat image and restore
-            # channels dim
-            inputs_flat = tf.reshape(inputs, [-1, num_channels])
-            inputs_flat = tf.cast(inputs_flat, tf.float32)
-            Ia = tf.gather(inputs_flat, idx_a)
-            Ib = tf.gather(inputs_flat, idx_b)
-            Ic = tf.gather(inputs_flat, idx_c)
-            Id = tf.gather(inputs_flat, idx_d)
-
-            # and finally calculate interpolated values
-            x0 = tf.cast(x0, tf.float32)
-            x1 = tf.cast(x1, tf.float32)
-            y0 = tf.cast(y0, tf.float32)
-            y1 = tf.cast(y1, tf.float32)
-            wa = tf.expand_dims(((x1 - x) * (y1 - y)), 1)
-            wb = tf.expand_dims(((x1 - x) * (y - y0)), 1)
-            wc = tf.expand_dims(((x - x0) * (y1 - y)), 1)
-            wd = tf.expand_dims(((x - x0) * (y - y0)), 1)
-
-            outputs = tf.add_n([wa * Ia, wb * Ib, wc * Ic, wd * Id])
-            return outputs
-
-    def meshgrid(height, width):
-        with tf.variable_scope("meshgrid"):
-            # This should be equivalent to:
-            #  x_t, y_t = np.meshgrid(np.linspace(-1, 1, width), np.linspace(-1, 1, height))
-            #  ones = np.ones(np.prod(x_t.shape))
-            #  grid = np.vstack([x_t.flatten(), y_t.flatten(), ones])
-            x_t = tf.matmul(tf.ones([height, 1]), tf.transpose(tf.expand_dims(tf.linspace(-1.0, 1.0, width), 1), [1, 0]))
-            y_t = tf.matmul(tf.expand_dims(tf.linspace(-1.0, 1.0, height), 1), tf.ones([1, width]))
-
-            x_t_flat = tf.reshape(x_t, [1, -1])
-            y_t_flat = tf.reshape(y_t, [1, -1])
-
-            grid = tf.concat([x_t_flat, y_t_flat, tf.ones_like(x_t_flat)], 0)
-            return grid
-
-    def transform(inputs, params, out_size):
-        with tf.variable_scope("transform"):
-            # constants
-            num_batch = tf.shape(inputs)[0]
-            height, width, num_channels = inputs.shape[1:]
-
-            params = tf.reshape(params, [-1, 2, 3])
-            params = tf.cast(params, tf.float32)
-
-            # grid of (x_t, y_t, 1), eq (1) in ref [1]
-            grid = meshgrid(out_size[0], out_size[1])
-            grid = tf.expand_dims(grid, 0)
-            grid = tf.reshape(grid, [-1])
-            grid = tf.tile(grid, [num_batch])
-            grid = tf.reshape(grid, [num_batch, 3, -1])
-
-            # Transform A x (x_t, y_t, 1)^T -> (x_s, y_s)
-            T_g = tf.matmul(params, grid)
-            x_s = tf.slice(T_g, [0, 0, 0], [-1, 1, -1])
-            y_s = tf.slice(T_g, [0, 1, 0], [-1, 1, -1])
-            x_s_flat = tf.reshape(x_s, [-1])
-            y_s_flat = tf.reshape(y_s, [-1])
-
-            outputs = interpolate(inputs, x_s_flat, y_s_flat, out_size)
+        num_batch = tf.shape(inputs)[0]
+        if data_format == "channels_first":
+            num_channels = inputs.shape[1]
+            height, width = tf.unstack(tf.shape(inputs)[2:])
+        else:
+            num_channels = inputs.shape[3]
+            height, width = tf.unstack(tf.shape(inputs)[1:3])
+
+        # Transform A x (x_t, y_t, 1)^T -> (x_s, y_s): [num_batch, 2, out_height * out_width]
+        grid = tf.constant(sampling_grid(*out_size).reshape([3, -1]))
+        x_s, y_s = tf.unstack(tf.tensordot(params, grid, axes=[[2], [0]]), axis=1)
+
+        # scale indices from [-1, 1] to [0, width/height]
+        x = (x_s + 1.0) * tf.cast(width, tf.float32) / 2.0
+        y = (y_s + 1.0) * tf.cast(height, tf.float32) / 2.0
+
+        x0 = tf.cast(tf.floor(x), tf.int32)
+        y0 = tf.cast(tf.floor(y), tf.int32)
+        x1 = tf.clip_by_value(x0 + 1, 0, width - 1)
+        y1 = tf.clip_by_value(y0 + 1, 0, height - 1)
+        x0 = tf.clip_by_value(x0, 0, width - 1)
+        y0 = tf.clip_by_value(y0, 0, height - 1)
+
+        # corners a, b, c, d in a single gather: [num_batch, 4 * out_height * out_width]
+        indices = tf.concat([y0 * width + x0, y1 * width + x0, y0 * width + x1, y1 * width + x1], axis=1)
+
+        # weights are computed with clipped corners (as in [2])
+        x0 = tf.cast(x0, tf.float32)
+        x1 = tf.cast(x1, tf.float32)
+        y0 = tf.cast(y0, tf.float32)
+        y1 = tf.cast(y1, tf.float32)
+        weights = tf.stack([(x1 - x) * (y1 - y), (x1 - x) * (y - y0), (x - x0) * (y1 - y), (x - x0) * (y - y0)], axis=1)
+
+        if data_format == "channels_first":
+            # [num_batch, num_channels, height * width] から各チャンネルで同じ位置を取り出す
+            inputs = tf.reshape(inputs, [num_batch, num_channels, -1])
+            indices = tf.broadcast_to(tf.expand_dims(indices, 1), [num_batch, num_channels, tf.shape(indices)[1]])
+            corners = tf.gather(inputs, indices, axis=2, batch_dims=2)
+            corners = tf.reshape(corners, [num_batch, num_channels, 4, -1])
+            outputs = tf.reduce_sum(corners * tf.expand_dims(weights, 1), axis=2)
+            outputs = tf.reshape(outputs, [num_batch, num_channels, out_size[0], out_size[1]])
+        else:
+            # [num_batch, height * width, num_channels] から位置ごとに全チャンネルを取り出す
+            inputs = tf.reshape(inputs, [num_batch, -1, num_channels])
+            corners = tf.gather(inputs, indices, axis=1, batch_dims=1)
+            corners = tf.reshape(corners, [num_batch, 4, -1, num_channels])
+            outputs = tf.reduce_sum(corners * tf.expand_dims(weights, 3), axis=1)
             outputs = tf.reshape(outputs, [num_batch, out_size[0], out_size[1], num_channels])
-            return outputs
 
-    with tf.variable_scope(name):
-        output = transform(inputs, params, out_size)
-        return output
+        return outputs
+
+
+def convert_images(inputs, data_format):
+    """ Convert uint8 images in channels_last (kept by dataset.input_fn(keep_uint8=True))
+    to float images in data_format. Float images are returned as they are.
+    """
+
+    if inputs.dtype != tf.uint8:
+        return inputs
+
+    inputs = tf.image.convert_image_dtype(inputs, tf.float32)
+
+    if data_format == "channels_first":
+        inputs = tf.transpose(inputs, [0, 3, 1, 2])
+
+    return inputs
 
 
 def bilinear_upsampling(inputs, size, align_corners, data_format):
@@ -162,13 +136,102 @@ def batch_normalization(inputs, data_format, training, name=None, reuse=None):
 
     return tf.layers.batch_normalization(
         inputs=inputs,
-        axis=1 if data_format == "channels_first" else 3,
+        axis=1 if data_format == "channels_first" else -1,
         training=training,
         name=name,
         reuse=reuse
     )
 
 
+def grouped_batch_normalization(inputs, num_groups, data_format, training, name=None, reuse=None,
+                                momentum=0.99, epsilon=1e-3):
+    """ Batch normalization of num_groups batches concatenated along the batch axis
+    ([num_groups * batch_size, ...], group-major) in a single pass.
+    Equivalent to calling batch_normalization on each group with shared variables (reuse=tf.AUTO_REUSE):
+    in training, statistics are computed for each group separately, so outputs are identical.
+    Moving statistics are updated by the closed form of num_groups moving-average updates applied in group order,
+    m <- momentum^N m + (1 - momentum) sum_g momentum^(N - 1 - g) mu_g,
+    so they are identical to updating by group 0, 1, ..., N - 1 one after another.
+    Variables are compatible with tf.layers.batch_normalization (same names, shapes and defaults).
+    training must be python bool.
+    """
+
+    ndims = inputs.shape.ndims
+    axis = 1 if data_format == "channels_first" else ndims - 1
+    channels = inputs.shape[axis].value
+
+    with tf.variable_scope(name, default_name="batch_normalization", reuse=reuse):
+
+        gamma = tf.get_variable(
+            name="gamma",
+            shape=[channels],
+            initializer=tf.ones_initializer()
+        )
+        beta = tf.get_variable(
+            name="beta",
+            shape=[channels],
+            initializer=tf.zeros_initializer()
+        )
+        moving_mean = tf.get_variable(
+            name="moving_mean",
+            shape=[channels],
+            initializer=tf.zeros_initializer(),
+            trainable=False
+        )
+        moving_variance = tf.get_variable(
+            name="moving_variance",
+            shape=[channels],
+            initializer=tf.ones_initializer(),
+            trainable=False
+        )
+
+        # [num_groups * batch_size, ...] => [num_groups, batch_size, ...]
+        static_shape = inputs.shape
+        inputs_shape = tf.shape(inputs)
+        inputs = tf.reshape(inputs, tf.concat([[num_groups, -1], inputs_shape[1:]], axis=0))
+
+        params_shape = [1] * (ndims + 1)
+        params_shape[axis + 1] = channels
+
+        if training:
+
+            reduction_axes = [i + 1 for i in range(ndims) if i != axis]
+            mean, variance = tf.nn.moments(inputs, axes=reduction_axes, keep_dims=True)
+
+            group_means = tf.reshape(mean, [num_groups, channels])
+            group_variances = tf.reshape(variance, [num_groups, channels])
+            # fused kernel (4-D inputs) updates moving variance with unbiased variance
+            if ndims == 4:
+                sample_size = tf.cast(tf.reduce_prod(tf.gather(tf.shape(inputs), reduction_axes)), tf.float32)
+                group_variances *= sample_size / tf.maximum(sample_size - 1.0, 1.0)
+
+            # m <- m - (m - mu_g) (1 - momentum) をg = 0, ..., N - 1の順に適用した結果
+            decay = momentum ** num_groups
+            weights = tf.constant((1.0 - momentum) * momentum ** np.arange(num_groups - 1, -1, -1), dtype=tf.float32)
+
+            tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf.assign(moving_mean, moving_mean * decay + tf.tensordot(weights, group_means, axes=1)))
+            tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf.assign(moving_variance, moving_variance * decay + tf.tensordot(weights, group_variances, axes=1)))
+
+        else:
+
+            mean = tf.reshape(moving_mean, params_shape)
+            variance = tf.reshape(moving_variance, params_shape)
+
+        outputs = tf.nn.batch_normalization(
+            x=inputs,
+            mean=mean,
+            variance=variance,
+            offset=tf.reshape(beta, params_shape),
+            scale=tf.reshape(gamma, params_shape),
+            variance_epsilon=epsilon
+        )
+
+        outputs = tf.reshape(outputs, inputs_shape)
+        outputs.set_shape(static_shape)
+
+        return outputs
+
+
 def group_normalization(inputs, groups, data_format, name=None, reuse=None):
 
     return tf.contrib.layers.group_norm(
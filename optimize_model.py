@@ -0,0 +1,226 @@
+# =============================================================
+# inference graph optimizer for SavedModels exported by --export
+# usage:
+#   python optimize_model.py \
+#       --saved_model_dir synth90k_hats_export/<timestamp> \
+#       --output_dir synth90k_hats_optimized \
+#       --filenames synth90k_test.tfrecord
+# =============================================================
+
+import tensorflow as tf
+import numpy as np
+import argparse
+import time
+import dataset
+import inference
+from tensorflow.python.framework import tensor_util
+from tensorflow.tools.graph_transforms import TransformGraph
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--saved_model_dir", type=str, help="SavedModel exported by *_main.py --export")
+parser.add_argument("--output_dir", type=str, help="output directory of optimized SavedModel")
+parser.add_argument("--filenames", type=str, nargs="+", help="tfrecords whose images are used for verification and latency")
+parser.add_argument("--num_images", type=int, default=100, help="number of images for verification")
+parser.add_argument("--batch_size", type=int, default=1, help="batch size for latency measurement")
+parser.add_argument("--number", type=int, default=20, help="number of measured runs")
+parser.add_argument("--atol", type=float, default=1e-3, help="absolute tolerance of float outputs")
+parser.add_argument("--rtol", type=float, default=1e-3, help="relative tolerance of float outputs")
+parser.add_argument("--max_mismatch_rate", type=float, default=0.01, help="maximum rate of images whose strings or class ids differ")
+parser.add_argument("--transforms", type=str, nargs="+", default=[
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+    "sort_by_execution_order",
+], help="graph transforms applied after folding batch normalization into conv/deconv")
+
+fused_batch_normalizations = ["FusedBatchNorm", "FusedBatchNormV2", "FusedBatchNormV3"]
+# kernelの出力チャンネルの軸
+output_channel_axes = dict(Conv2D=3, Conv2DBackpropInput=2)
+
+
+def node_name(input_name):
+
+    return input_name.lstrip("^").split(":")[0]
+
+
+def fold_conv_batch_normalizations(graph_def):
+    '''
+    fold inference mode FusedBatchNorm into preceding Conv2D / Conv2DBackpropInput (conv2d_transpose)
+    whose kernel is constant, including ones inside while loops.
+    TransformGraph's fold_old_batch_norms doesn't handle conv2d_transpose nor nodes in while loops.
+    returns number of folded batch normalizations
+    '''
+
+    nodes = {node.name: node for node in graph_def.node}
+    consumers = {}
+    for node in graph_def.node:
+        for input_name in node.input:
+            consumers.setdefault(node_name(input_name), []).append((node.name, input_name))
+
+    def resolve(input_name):
+        # Identity(variableの読み出し)とEnter(while loopへの入力)をたどって定数を探す
+        # returns (value, Enter nodes from the consumer side)
+        node = nodes[node_name(input_name)]
+        enters = []
+        while node.op in ["Identity", "Enter"]:
+            if node.op == "Enter":
+                enters.append(node)
+            node = nodes[node_name(node.input[0])]
+        if node.op != "Const":
+            return None, None
+        return tensor_util.MakeNdarray(node.attr["value"].tensor), enters
+
+    def add_constant(name, value, enters):
+        # 元の定数がwhile loopの中で使われていたなら同じEnterの列を通す
+        constant = graph_def.node.add()
+        constant.op = "Const"
+        constant.name = name
+        constant.attr["dtype"].type = tf.as_dtype(value.dtype).as_datatype_enum
+        constant.attr["value"].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+        input_name = constant.name
+        for i, enter in enumerate(reversed(enters)):
+            new_enter = graph_def.node.add()
+            new_enter.CopyFrom(enter)
+            new_enter.name = "{}/Enter_{}".format(name, i)
+            new_enter.input[:] = [input_name]
+            input_name = new_enter.name
+        return input_name
+
+    num_folded = 0
+
+    for node in list(graph_def.node):
+
+        if node.op not in fused_batch_normalizations or node.attr["is_training"].b:
+            continue
+
+        conv = nodes[node_name(node.input[0])]
+        if conv.op not in output_channel_axes:
+            continue
+        # convの出力がbatch normalization以外でも使われていれば変更できない
+        if len(consumers.get(conv.name, [])) != 1:
+            continue
+        # batch normalizationの2番目以降の出力(batch mean等)が使われていないこと
+        if any(input_name not in [node.name, node.name + ":0"] for _, input_name in consumers.get(node.name, [])):
+            continue
+
+        kernel, kernel_enters = resolve(conv.input[1])
+        (scale, scale_enters), (offset, _), (mean, _), (variance, _) = map(resolve, node.input[1:5])
+        if any(value is None for value in [kernel, scale, offset, mean, variance]):
+            continue
+
+        multiplier = scale / np.sqrt(variance + node.attr["epsilon"].f)
+        shape = [1] * kernel.ndim
+        shape[output_channel_axes[conv.op]] = -1
+
+        conv.input[1] = add_constant("{}/folded_kernel".format(conv.name), kernel * multiplier.reshape(shape), kernel_enters)
+        bias = add_constant("{}/folded_bias".format(node.name), offset - mean * multiplier, scale_enters)
+
+        # batch normalizationをBiasAddに置き換える
+        data_format = node.attr["data_format"].s
+        dtype = node.attr["T"].type
+        control_inputs = [input_name for input_name in node.input if input_name.startswith("^")]
+        node.op = "BiasAdd"
+        node.ClearField("attr")
+        node.attr["T"].type = dtype
+        node.attr["data_format"].s = data_format
+        node.input[:] = [conv.name, bias] + control_inputs
+
+        num_folded += 1
+
+    return num_folded
+
+
+def optimize(saved_model_dir, output_dir, transforms):
+
+    with tf.Graph().as_default(), tf.Session() as session:
+
+        signature = inference.load_signature(session, saved_model_dir)
+        input_names = [node_name(tensor_info.name) for tensor_info in signature.inputs.values()]
+        output_names = [node_name(tensor_info.name) for tensor_info in signature.outputs.values()]
+
+        # 変数を定数にして出力に必要な部分だけ残す (summaryやlossは含まれない)
+        graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+
+    num_nodes = len(graph_def.node)
+
+    num_folded = fold_conv_batch_normalizations(graph_def)
+
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+    graph_def = TransformGraph(graph_def, input_names, output_names, transforms)
+
+    print("{} batch normalization(s) folded into conv/deconv, {} => {} nodes".format(num_folded, num_nodes, len(graph_def.node)))
+
+    with tf.Graph().as_default() as graph, tf.Session() as session:
+
+        tf.import_graph_def(graph_def, name="")
+
+        builder = tf.saved_model.builder.SavedModelBuilder(output_dir)
+        builder.add_meta_graph_and_variables(
+            sess=session,
+            tags=[tf.saved_model.tag_constants.SERVING],
+            signature_def_map={
+                tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: tf.saved_model.signature_def_utils.predict_signature_def(
+                    inputs={key: graph.get_tensor_by_name(tensor_info.name) for key, tensor_info in signature.inputs.items()},
+                    outputs={key: graph.get_tensor_by_name(tensor_info.name) for key, tensor_info in signature.outputs.items()}
+                )
+            }
+        )
+        builder.save()
+
+
+def verify(predictor, optimized_predictor, encoded_images, atol, rtol, max_mismatch_rate):
+    '''
+    batch normalization folding changes float rounding, so outputs are not exactly same.
+    float outputs are compared by np.allclose, and strings and class ids by the rate of mismatched images
+    '''
+
+    outputs = predictor(encoded_images)
+    optimized_outputs = optimized_predictor(encoded_images)
+
+    for key in sorted(outputs):
+        if outputs[key].dtype.kind in "SUO" or (outputs[key].dtype.kind in "iu" and outputs[key].dtype != np.uint8):
+            # argmaxの境界付近の画像では文字が変わることがある
+            mismatches = np.not_equal(outputs[key], optimized_outputs[key]).reshape([len(encoded_images), -1])
+            mismatch_rate = np.mean(np.any(mismatches, axis=1))
+            print("    {:<16} mismatch rate: {:.4f}".format(key, mismatch_rate))
+            assert mismatch_rate <= max_mismatch_rate, key
+        else:
+            difference = np.abs(outputs[key].astype(np.float64) - optimized_outputs[key].astype(np.float64))
+            print("    {:<16} max abs difference: {:.3e}".format(key, np.max(difference)))
+            # uint8に量子化された出力は丸めの境界で1だけずれることがある
+            if outputs[key].dtype == np.uint8:
+                assert np.max(difference) <= 1, key
+            else:
+                assert np.allclose(outputs[key], optimized_outputs[key], rtol=rtol, atol=atol), key
+
+
+def measure(predictor, encoded_images, number):
+
+    predictor(encoded_images)
+
+    begin = time.time()
+    for _ in range(number):
+        predictor(encoded_images)
+
+    return (time.time() - begin) / number / len(encoded_images)
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    optimize(args.saved_model_dir, args.output_dir, args.transforms)
+
+    predictor = inference.SavedModelPredictor(args.saved_model_dir)
+    optimized_predictor = inference.SavedModelPredictor(args.output_dir)
+
+    encoded_images = dataset.load_encoded_images(args.filenames, args.num_images)
+
+    print("==================================================")
+    print("verification ({} images)".format(len(encoded_images)))
+    verify(predictor, optimized_predictor, encoded_images, args.atol, args.rtol, args.max_mismatch_rate)
+
+    print("==================================================")
+    print("CPU latency (batch size: {})".format(args.batch_size))
+    print("    original:  {:.3e} sec/image".format(measure(predictor, encoded_images[:args.batch_size], args.number)))
+    print("    optimized: {:.3e} sec/image".format(measure(optimized_predictor, encoded_images[:args.batch_size], args.number)))
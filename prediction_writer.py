@@ -0,0 +1,74 @@
+import numpy as np
+import glob
+
+
+class PredictionWriter(object):
+    '''
+    write predictions of estimator.predict incrementally to compressed shards
+    ("<filename_prefix>-00000.npz", ...) instead of holding all of them in memory.
+    each shard contains up to shard_size records as arrays stacked for each output key
+    '''
+
+    def __init__(self, filename_prefix, shard_size=10000):
+
+        self.filename_prefix = filename_prefix
+        self.shard_size = shard_size
+        self.buffer = []
+        self.num_shards = 0
+        self.num_records = 0
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+    def write(self, prediction):
+
+        self.buffer.append(prediction)
+        self.num_records += 1
+
+        if len(self.buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+
+        if not self.buffer:
+            return
+
+        np.savez_compressed(
+            "{}-{:05d}.npz".format(self.filename_prefix, self.num_shards),
+            **{key: np.stack([prediction[key] for prediction in self.buffer]) for key in self.buffer[0]}
+        )
+
+        self.buffer = []
+        self.num_shards += 1
+
+    def close(self):
+
+        self.flush()
+
+
+def shard_filenames(filename_prefix):
+    '''
+    shards written by PredictionWriter in order
+    '''
+
+    return sorted(glob.glob("{}-[0-9][0-9][0-9][0-9][0-9].npz".format(filename_prefix)))
+
+
+def read_predictions(filename_prefix):
+    '''
+    iterate over predictions written by PredictionWriter in order
+    '''
+
+    for filename in shard_filenames(filename_prefix):
+
+        with np.load(filename) as shard:
+
+            predictions = {key: shard[key] for key in shard.files}
+
+        for values in zip(*predictions.values()):
+            yield dict(zip(predictions.keys(), values))
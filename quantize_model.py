@@ -0,0 +1,197 @@
+# =============================================================
+# post-training quantization for CPU inference
+# usage:
+#   python synth90k_main.py --export --export_numeric --data_format channels_last \
+#       --model_dir synth90k_hats_model_channels_last
+#   python quantize_model.py --setting synth90k \
+#       --saved_model_dir synth90k_hats_export/<timestamp> \
+#       --output_filename synth90k_hats_int8.tflite
+# tflite supports only channels_last (NHWC) convolutions.
+# channels_first HATS checkpoints cannot be restored as channels_last. models trained after
+# models.hats.record_data_format was added are checked by models.hats.check_data_format.
+# export without --attention_maps so that predictions is the only output
+# =============================================================
+
+import tensorflow as tf
+import numpy as np
+import argparse
+import itertools
+import time
+import dataset
+import metrics
+import inference
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--setting", type=str, default="synth90k", choices=["chars74k", "synth90k", "multi_synth90k"], help="setting of entry script")
+parser.add_argument("--saved_model_dir", type=str, help="SavedModel exported by *_main.py --export --export_numeric")
+parser.add_argument("--output_filename", type=str, help="quantized tflite model")
+parser.add_argument("--mode", type=str, default="int8", choices=["int8", "dynamic"], help="int8: weights and activations (calibrated), dynamic: weights only")
+parser.add_argument("--calibration_filenames", type=str, nargs="+", default=None, help="tfrecords for calibration (default: training tfrecord of the setting)")
+parser.add_argument("--num_calibration_images", type=int, default=300, help="number of images for calibration")
+parser.add_argument("--test_filenames", type=str, nargs="+", default=None, help="tfrecords for accuracy (default: test tfrecord of the setting)")
+parser.add_argument("--num_test_images", type=int, default=1000, help="number of images for accuracy")
+parser.add_argument("--number", type=int, default=100, help="number of images for latency measurement")
+
+# chars74k_main.py, synth90k_main.py, multi_synth90k_main.pyの設定
+settings = dict(
+    chars74k=dict(train_filenames=["chars74k_train.tfrecord"], test_filenames=["chars74k_test.tfrecord"],
+                  sequence_lengths=[], encoding="png", image_size=[128, 128], num_classes=37),
+    synth90k=dict(train_filenames=["synth90k_train.tfrecord"], test_filenames=["synth90k_test.tfrecord"],
+                  sequence_lengths=[24], encoding="jpeg", image_size=[256, 256], num_classes=37),
+    multi_synth90k=dict(train_filenames=["multi_synth90k_train.tfrecord"], test_filenames=["multi_synth90k_test.tfrecord"],
+                        sequence_lengths=[5, 11], encoding="jpeg", image_size=[256, 256], num_classes=37),
+)
+
+
+def load_images(filenames, num_images, setting):
+    '''
+    uint8 images [1, height, width, 3] and labels from dataset.input_fn (same preprocessing as training)
+    '''
+
+    with tf.Graph().as_default():
+
+        images, labels = dataset.input_fn(
+            filenames=filenames,
+            batch_size=1,
+            num_epochs=1,
+            shuffle=False,
+            sequence_lengths=setting["sequence_lengths"],
+            encoding=setting["encoding"],
+            image_size=setting["image_size"],
+            data_format="channels_last",
+            keep_uint8=True
+        )
+
+        with tf.Session() as session:
+
+            def generator():
+                while True:
+                    try:
+                        yield session.run([images, labels])
+                    except tf.errors.OutOfRangeError:
+                        return
+
+            return list(itertools.islice(generator(), num_images))
+
+
+def quantize(saved_model_dir, mode, calibration_images):
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    # activationの量子化範囲は学習データの画像で決める
+    if mode == "int8":
+        converter.representative_dataset = tf.lite.RepresentativeDataset(
+            lambda: ([images] for images, _ in calibration_images)
+        )
+
+    return converter.convert()
+
+
+class TFLitePredictor(object):
+
+    def __init__(self, model_content):
+
+        self.interpreter = tf.lite.Interpreter(model_content=model_content)
+        self.interpreter.allocate_tensors()
+
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        # --attention_mapsなしでexportしたモデルの出力はpredictionsのみ
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+
+    def __call__(self, images):
+
+        self.interpreter.set_tensor(self.input_index, images)
+        self.interpreter.invoke()
+
+        return dict(predictions=self.interpreter.get_tensor(self.output_index))
+
+
+def evaluate(predictor, test_images, setting):
+    '''
+    word accuracy and edit distance computed in the same way as HATS (accuracy for Classifier)
+    '''
+
+    predictions = np.concatenate([predictor(images)["predictions"] for images, _ in test_images], axis=0)
+    labels = np.concatenate([labels for _, labels in test_images], axis=0)
+
+    if not setting["sequence_lengths"]:
+        return dict(accuracy=np.mean(predictions == labels))
+
+    blank = setting["num_classes"] - 1
+
+    with tf.Graph().as_default():
+
+        # 単語構造のみを残して残りはバッチ方向に展開し, blankのみ含む単語を削除
+        labels = tf.reshape(tf.constant(labels, dtype=tf.int32), [-1, setting["sequence_lengths"][-1]])
+        predictions = tf.reshape(tf.constant(predictions, dtype=tf.int32), [-1, setting["sequence_lengths"][-1]])
+        indices = tf.where(tf.reduce_any(tf.not_equal(labels, blank), axis=1))
+        labels = tf.gather_nd(labels, indices)
+        predictions = tf.gather_nd(predictions, indices)
+
+        sequence_lengths = tf.count_nonzero(tf.not_equal(labels, blank), axis=1) + 1
+        sequence_mask = tf.sequence_mask(sequence_lengths, labels.shape[-1], dtype=tf.int32)
+
+        word_accuracy = tf.reduce_mean(tf.cast(tf.reduce_all(tf.equal(
+            x=predictions * sequence_mask,
+            y=labels * sequence_mask
+        ), axis=1), dtype=tf.float32))
+        # metrics.edit_distanceはlogitsを受け取るのでone-hotにして渡す
+        edit_distance = metrics.edit_distance(
+            labels=labels,
+            logits=tf.one_hot(predictions, setting["num_classes"]),
+            sequence_lengths=sequence_lengths,
+            normalize=True
+        )
+
+        with tf.Session() as session:
+
+            word_accuracy, edit_distance = session.run([word_accuracy, edit_distance])
+
+    return dict(word_accuracy=word_accuracy, edit_distance=edit_distance)
+
+
+def measure(predictor, test_images, number):
+
+    predictor(test_images[0][0])
+
+    begin = time.time()
+    for images, _ in itertools.islice(itertools.cycle(test_images), number):
+        predictor(images)
+
+    return (time.time() - begin) / number
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    setting = settings[args.setting]
+
+    calibration_images = load_images(args.calibration_filenames or setting["train_filenames"], args.num_calibration_images, setting)
+    test_images = load_images(args.test_filenames or setting["test_filenames"], args.num_test_images, setting)
+
+    model_content = quantize(args.saved_model_dir, args.mode, calibration_images)
+
+    with open(args.output_filename, "wb") as f:
+        f.write(model_content)
+
+    predictors = dict(
+        float=inference.SavedModelPredictor(args.saved_model_dir),
+        quantized=TFLitePredictor(model_content)
+    )
+
+    results = {name: evaluate(predictor, test_images, setting) for name, predictor in predictors.items()}
+    latencies = {name: measure(predictor, test_images, args.number) for name, predictor in predictors.items()}
+
+    print("==================================================")
+    print("{} ({} quantization, {} test images) => {}".format(args.setting, args.mode, len(test_images), args.output_filename))
+    for name in predictors:
+        print("    {:<10} {}, CPU latency: {:.3e} sec/image".format(
+            name,
+            ", ".join("{}: {:.4f}".format(key, value) for key, value in sorted(results[name].items())),
+            latencies[name]
+        ))
+    print("    {:<10} {}".format("delta", ", ".join(
+        "{}: {:+.4f}".format(key, results["quantized"][key] - results["float"][key]) for key in sorted(results["float"])
+    )))
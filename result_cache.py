@@ -0,0 +1,175 @@
+import numpy as np
+import collections
+import threading
+import hashlib
+import glob
+import os
+
+
+def model_version(saved_model_dir):
+    '''
+    digest of graph and variable index (which includes checksums of variables) of SavedModel.
+    re-exported or optimized models get a different version even if the directory is reused
+    '''
+
+    digest = hashlib.sha256()
+
+    for filename in ["saved_model.pb", os.path.join("variables", "variables.index")]:
+        filename = os.path.join(saved_model_dir, filename)
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()[:16]
+
+
+# ディスク上のエントリに書き込むモデルのバージョン
+version_key = "__model_version__"
+
+
+def entry_bytes(outputs):
+
+    return sum(len(value) if isinstance(value, bytes) else np.asarray(value).nbytes for value in outputs.values())
+
+
+class ResultCache(object):
+    '''
+    LRU cache of outputs of a single image (dict of arrays) keyed by hash of encoded image bytes and model version.
+    entries are evicted from least recently used until both max_entries and max_bytes are satisfied.
+    if directory is given, entries are also written there ("<key>.npz") and loaded on construction,
+    so that they survive restarts (LRU order on disk is the order of insertion).
+    entries on disk written under another model version can never hit, so they are deleted on load.
+    thread safe
+    '''
+
+    def __init__(self, model_version, max_entries, max_bytes, directory=None):
+
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.load()
+
+    def key(self, encoded_image):
+
+        digest = hashlib.sha256(self.model_version.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(encoded_image)
+
+        return digest.hexdigest()
+
+    def filename(self, key):
+
+        return os.path.join(self.directory, "{}.npz".format(key))
+
+    def load(self):
+
+        filenames = sorted(glob.glob(os.path.join(self.directory, "*.npz")), key=os.path.getmtime)
+
+        for filename in filenames:
+            try:
+                with np.load(filename) as entry:
+                    outputs = {key: entry[key] for key in entry.files}
+            except (OSError, ValueError):
+                # 書き込み途中で終了したファイルなど
+                os.remove(filename)
+                continue
+            # 別のモデルのエントリはヒットしないので読み込まずに削除する
+            if str(outputs.pop(version_key, "")) != self.model_version:
+                os.remove(filename)
+                continue
+            self.remove(self.insert(os.path.splitext(os.path.basename(filename))[0], outputs))
+
+    def get(self, key):
+
+        with self.lock:
+            outputs = self.entries.get(key)
+            if outputs is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return outputs
+
+    def put(self, key, outputs):
+
+        # ロック中はメモリ上のLRUだけを更新し，ディスクへの書き込みと削除はロックの外で行う
+        # (getはイベントループのスレッドから呼ばれる)
+        with self.lock:
+            if key in self.entries:
+                return
+            # バッチの出力のviewを保持しないようにコピーする
+            outputs = {name: value.copy() if isinstance(value, np.ndarray) else value for name, value in outputs.items()}
+            evicted_keys = self.insert(key, outputs)
+            # 追い出されずに残った場合のみ書き込む
+            inserted = key in self.entries
+
+        if self.directory:
+            self.remove(evicted_keys)
+            if inserted:
+                self.write(key, outputs)
+                # 書き込み中に追い出された場合はファイルを残さない
+                with self.lock:
+                    evicted = key not in self.entries
+                if evicted:
+                    self.remove([key])
+
+    def write(self, key, outputs):
+
+        filename = self.filename(key)
+
+        try:
+            with open(filename + ".tmp", "wb") as f:
+                np.savez(f, **{version_key: np.array(self.model_version)}, **outputs)
+            os.replace(filename + ".tmp", filename)
+        finally:
+            if os.path.exists(filename + ".tmp"):
+                os.remove(filename + ".tmp")
+
+    def remove(self, keys):
+
+        for key in keys:
+            try:
+                os.remove(self.filename(key))
+            except FileNotFoundError:
+                pass
+
+    def insert(self, key, outputs):
+        '''
+        insert into in-memory LRU and return evicted keys (their files are not removed)
+        '''
+
+        self.entries[key] = outputs
+        self.num_bytes += entry_bytes(outputs)
+
+        evicted_keys = []
+
+        while self.entries and (len(self.entries) > self.max_entries or self.num_bytes > self.max_bytes):
+            evicted_key, evicted_outputs = self.entries.popitem(last=False)
+            self.num_bytes -= entry_bytes(evicted_outputs)
+            self.evictions += 1
+            evicted_keys.append(evicted_key)
+
+        return evicted_keys
+
+    def snapshot(self):
+
+        with self.lock:
+            return dict(
+                model_version=self.model_version,
+                num_entries=len(self.entries),
+                num_bytes=self.num_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                hit_rate=self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+            )
@@ -0,0 +1,314 @@
+# =============================================================
+# micro-batching inference server (HTTP on localhost) for SavedModels exported by --export
+# usage:
+#   python synth90k_main.py --export --model_dir synth90k_hats_model
+#   python server.py --saved_model_dir synth90k_hats_export/<timestamp> --port 8080
+#   curl --data-binary @image.jpg http://127.0.0.1:8080/predict
+#   curl http://127.0.0.1:8080/metrics
+# with --cache_max_entries, outputs of byte-identical images are returned from ResultCache
+# requests are queued and run as batches of up to --max_batch_size images,
+# waiting at most --max_wait_ms after the first request of the batch
+# =============================================================
+
+import numpy as np
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+import sys
+import inference
+import result_cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--saved_model_dir", type=str, help="SavedModel exported by *_main.py --export (encoded image input)")
+parser.add_argument("--host", type=str, default="127.0.0.1", help="host to listen on")
+parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+parser.add_argument("--max_batch_size", type=int, default=32, help="maximum number of images in a batch")
+parser.add_argument("--max_wait_ms", type=float, default=5.0, help="maximum time to wait for a batch to be filled")
+parser.add_argument("--num_workers", type=int, default=2, help="number of threads running batches concurrently")
+parser.add_argument("--cache_max_entries", type=int, default=0, help="maximum number of cached results (0: no cache)")
+parser.add_argument("--cache_max_bytes", type=int, default=256 * 1024 * 1024, help="maximum bytes of cached results")
+parser.add_argument("--cache_dir", type=str, default=None, help="directory where cached results persist across restarts")
+parser.add_argument("--model_version", type=str, default=None, help="model version in cache keys (default: digest of SavedModel)")
+parser.add_argument("--metrics_window", type=int, default=10000, help="number of recent requests for latency percentiles")
+
+reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class Metrics(object):
+    '''
+    request / batch counters and latencies of recent requests
+    '''
+
+    def __init__(self, window):
+
+        self.begin = time.time()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+        self.num_batched_images = 0
+        # (完了時刻, latency)
+        self.requests = collections.deque(maxlen=window)
+
+    def add_batch(self, batch_size):
+
+        self.num_batches += 1
+        self.num_batched_images += batch_size
+
+    def add_request(self, latency, error=False):
+
+        self.num_requests += 1
+        self.num_errors += error
+        self.requests.append((time.time(), latency))
+
+    def snapshot(self, queue_size):
+
+        finish_times, latencies = zip(*self.requests) if self.requests else ([], [])
+        elapsed_time = finish_times[-1] - finish_times[0] if len(finish_times) > 1 else 0.0
+
+        return dict(
+            uptime=time.time() - self.begin,
+            num_requests=self.num_requests,
+            num_errors=self.num_errors,
+            num_batches=self.num_batches,
+            num_batched_images=self.num_batched_images,
+            mean_batch_size=self.num_batched_images / self.num_batches if self.num_batches else 0.0,
+            queue_size=queue_size,
+            # 直近のリクエストについての値
+            throughput=(len(finish_times) - 1) / elapsed_time if elapsed_time else 0.0,
+            latency_mean=float(np.mean(latencies)) if latencies else 0.0,
+            latency_p50=float(np.percentile(latencies, 50)) if latencies else 0.0,
+            latency_p99=float(np.percentile(latencies, 99)) if latencies else 0.0,
+        )
+
+
+class MicroBatcher(object):
+    '''
+    collect requests into batches bounded by max_batch_size and max_wait_ms
+    and run predictor(list of encoded images) -> dict of outputs on a thread pool.
+    at most num_workers batches are run at once; requests arriving meanwhile form the next batch.
+    if a batch fails, its requests are run one by one so that only the failing requests get the exception
+    '''
+
+    def __init__(self, predictor, max_batch_size, max_wait_ms, num_workers, metrics):
+
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.semaphore = asyncio.Semaphore(num_workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+        # 実行中のバッチ (taskへの参照を保持する)
+        self.tasks = set()
+
+    async def predict(self, encoded_image):
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((encoded_image, future))
+
+        return await future
+
+    async def next_batch(self):
+
+        loop = asyncio.get_running_loop()
+
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # 既にキューにあるものは待たずに取り出す
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def run(self):
+
+        while True:
+            # workerが空くまでバッチを確定しないので，その間に届いたリクエストもまとめられる
+            await self.semaphore.acquire()
+            batch = await self.next_batch()
+            task = asyncio.ensure_future(self.dispatch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def dispatch(self, batch):
+
+        try:
+            try:
+                await self.run_batch(batch)
+            except Exception as exception:
+                if len(batch) == 1:
+                    self.fail(batch, exception)
+                else:
+                    # decodeできない画像が1枚でもあるとバッチ全体が失敗するので，
+                    # 1枚ずつやり直して失敗したリクエストだけをエラーにする
+                    for request in batch:
+                        try:
+                            await self.run_batch([request])
+                        except Exception as exception:
+                            self.fail([request], exception)
+        finally:
+            self.semaphore.release()
+
+    async def run_batch(self, batch):
+
+        encoded_images, futures = zip(*batch)
+
+        outputs = await asyncio.get_running_loop().run_in_executor(self.executor, self.predictor, list(encoded_images))
+
+        self.metrics.add_batch(len(batch))
+        for i, future in enumerate(futures):
+            if not future.done():
+                future.set_result({key: value[i] for key, value in outputs.items()})
+
+    def fail(self, batch, exception):
+
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exception)
+
+
+def jsonable(value):
+
+    value = np.asarray(value)
+
+    if value.dtype.kind in "SO":
+        value = np.vectorize(lambda string: string.decode("utf-8"), otypes=[object])(value)
+
+    return value.tolist()
+
+
+def log_cache_error(future):
+
+    # ResultCache.putの例外(ディスクの容量不足など)を握りつぶさない
+    if not future.cancelled() and future.exception() is not None:
+        print("failed to cache result: {!r}".format(future.exception()), file=sys.stderr, flush=True)
+
+
+class Server(object):
+    '''
+    minimal HTTP/1.1 server (keep-alive) on asyncio streams
+        POST /predict: encoded image (jpeg / png) as body => JSON of outputs
+        GET /metrics: JSON of Metrics.snapshot (and ResultCache.snapshot)
+    '''
+
+    def __init__(self, batcher, metrics, cache=None):
+
+        self.batcher = batcher
+        self.metrics = metrics
+        self.cache = cache
+
+    async def handle(self, method, path, body):
+
+        if path == "/metrics":
+            if method != "GET":
+                return 405, dict(error="use GET")
+            metrics = self.metrics.snapshot(self.batcher.queue.qsize())
+            if self.cache:
+                metrics["cache"] = self.cache.snapshot()
+            return 200, metrics
+
+        if path == "/predict":
+            if method != "POST":
+                return 405, dict(error="use POST")
+            if not body:
+                return 400, dict(error="empty body")
+            begin = time.time()
+            # キャッシュにあればバッチを待たずに返す
+            key = self.cache.key(body) if self.cache else None
+            outputs = self.cache.get(key) if self.cache else None
+            if outputs is None:
+                try:
+                    outputs = await self.batcher.predict(body)
+                except Exception as exception:
+                    self.metrics.add_request(time.time() - begin, error=True)
+                    return 500, dict(error=str(exception))
+                if self.cache:
+                    # ディスクへの書き込みでイベントループを止めない
+                    future = asyncio.get_running_loop().run_in_executor(None, self.cache.put, key, outputs)
+                    future.add_done_callback(log_cache_error)
+            self.metrics.add_request(time.time() - begin)
+            return 200, {key: jsonable(value) for key, value in outputs.items()}
+
+        return 404, dict(error="not found: {}".format(path))
+
+    async def __call__(self, reader, writer):
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b"\r\n", b"\n", b""]:
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response = await self.handle(method, path, body)
+                response = json.dumps(response).encode("utf-8")
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                    status, reasons[status], len(response), "keep-alive" if keep_alive else "close"
+                ).encode("latin-1") + response)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+
+    predictor = inference.SavedModelPredictor(args.saved_model_dir)
+    metrics = Metrics(args.metrics_window)
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_wait_ms, args.num_workers, metrics)
+    cache = result_cache.ResultCache(
+        model_version=args.model_version or result_cache.model_version(args.saved_model_dir),
+        max_entries=args.cache_max_entries,
+        max_bytes=args.cache_max_bytes,
+        directory=args.cache_dir
+    ) if args.cache_max_entries else None
+
+    server = await asyncio.start_server(Server(batcher, metrics, cache), args.host, args.port)
+    batcher_task = asyncio.ensure_future(batcher.run())
+
+    print("serving {} on http://{}:{} (max_batch_size: {}, max_wait_ms: {}, num_workers: {}, cached results: {})".format(
+        args.saved_model_dir, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.num_workers,
+        len(cache.entries) if cache else None
+    ), flush=True)
+
+    async with server:
+        await server.serve_forever()
+
+    batcher_task.cancel()
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    asyncio.run(serve(args))
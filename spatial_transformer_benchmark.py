@@ -0,0 +1,190 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+from networks import ops
+from benchmark_utils import measure
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=100, help="batch size")
+parser.add_argument("--input_shape", type=int, nargs=3, default=[64, 32, 32], help="shape of inputs [C, H, W]")
+parser.add_argument("--out_size", type=int, nargs=2, default=[32, 32], help="size of outputs [H, W]")
+parser.add_argument("--number", type=int, default=20, help="number of measured runs")
+parser.add_argument("--random_seed", type=int, default=1209, help="random seed")
+
+
+def reference_spatial_transformer(inputs, params, out_size, name="reference_spatial_transformer"):
+    '''
+    networks.ops.spatial_transformer before vectorization (channels_last only)
+    '''
+
+    def repeat(inputs, num_repeats):
+        with tf.variable_scope("repeat"):
+            rep = tf.transpose(tf.expand_dims(tf.ones([num_repeats]), 1), [1, 0])
+            rep = tf.cast(rep, tf.int32)
+            outputs = tf.matmul(tf.reshape(inputs, [-1, 1]), rep)
+            outputs = tf.reshape(outputs, [-1])
+            return outputs
+
+    def interpolate(inputs, x, y, out_size):
+        with tf.variable_scope("interpolate"):
+            # constants
+            num_batch = tf.shape(inputs)[0]
+            height = tf.shape(inputs)[1]
+            width = tf.shape(inputs)[2]
+            num_channels = inputs.shape[3]
+
+            x = tf.cast(x, tf.float32)
+            y = tf.cast(y, tf.float32)
+
+            # scale indices from [-1, 1] to [0, width/height]
+            x = (x + 1.0) * tf.cast(width, tf.float32) / 2.0
+            y = (y + 1.0) * tf.cast(height, tf.float32) / 2.0
+
+            # do sampling
+            x0 = tf.cast(tf.floor(x), tf.int32)
+            x1 = x0 + 1
+            y0 = tf.cast(tf.floor(y), tf.int32)
+            y1 = y0 + 1
+
+            zero = tf.zeros([], tf.int32)
+            max_y = tf.cast(tf.shape(inputs)[1] - 1, tf.int32)
+            max_x = tf.cast(tf.shape(inputs)[2] - 1, tf.int32)
+
+            x0 = tf.clip_by_value(x0, zero, max_x)
+            x1 = tf.clip_by_value(x1, zero, max_x)
+            y0 = tf.clip_by_value(y0, zero, max_y)
+            y1 = tf.clip_by_value(y1, zero, max_y)
+            dim2 = width
+            dim1 = width * height
+            base = repeat(tf.range(num_batch) * dim1, out_size[0] * out_size[1])
+            base_y0 = base + y0 * dim2
+            base_y1 = base + y1 * dim2
+            idx_a = base_y0 + x0
+            idx_b = base_y1 + x0
+            idx_c = base_y0 + x1
+            idx_d = base_y1 + x1
+
+            # use indices to lookup pixels in the flat image and restore
+            # channels dim
+            inputs_flat = tf.reshape(inputs, [-1, num_channels])
+            inputs_flat = tf.cast(inputs_flat, tf.float32)
+            Ia = tf.gather(inputs_flat, idx_a)
+            Ib = tf.gather(inputs_flat, idx_b)
+            Ic = tf.gather(inputs_flat, idx_c)
+            Id = tf.gather(inputs_flat, idx_d)
+
+            # and finally calculate interpolated values
+            x0 = tf.cast(x0, tf.float32)
+            x1 = tf.cast(x1, tf.float32)
+            y0 = tf.cast(y0, tf.float32)
+            y1 = tf.cast(y1, tf.float32)
+            wa = tf.expand_dims(((x1 - x) * (y1 - y)), 1)
+            wb = tf.expand_dims(((x1 - x) * (y - y0)), 1)
+            wc = tf.expand_dims(((x - x0) * (y1 - y)), 1)
+            wd = tf.expand_dims(((x - x0) * (y - y0)), 1)
+
+            outputs = tf.add_n([wa * Ia, wb * Ib, wc * Ic, wd * Id])
+            return outputs
+
+    def meshgrid(height, width):
+        with tf.variable_scope("meshgrid"):
+            # This should be equivalent to:
+            #  x_t, y_t = np.meshgrid(np.linspace(-1, 1, width), np.linspace(-1, 1, height))
+            #  ones = np.ones(np.prod(x_t.shape))
+            #  grid = np.vstack([x_t.flatten(), y_t.flatten(), ones])
+            x_t = tf.matmul(tf.ones([height, 1]), tf.transpose(tf.expand_dims(tf.linspace(-1.0, 1.0, width), 1), [1, 0]))
+            y_t = tf.matmul(tf.expand_dims(tf.linspace(-1.0, 1.0, height), 1), tf.ones([1, width]))
+
+            x_t_flat = tf.reshape(x_t, [1, -1])
+            y_t_flat = tf.reshape(y_t, [1, -1])
+
+            grid = tf.concat([x_t_flat, y_t_flat, tf.ones_like(x_t_flat)], 0)
+            return grid
+
+    def transform(inputs, params, out_size):
+        with tf.variable_scope("transform"):
+            # constants
+            num_batch = tf.shape(inputs)[0]
+            height, width, num_channels = inputs.shape[1:]
+
+            params = tf.reshape(params, [-1, 2, 3])
+            params = tf.cast(params, tf.float32)
+
+            # grid of (x_t, y_t, 1), eq (1) in ref [1]
+            grid = meshgrid(out_size[0], out_size[1])
+            grid = tf.expand_dims(grid, 0)
+            grid = tf.reshape(grid, [-1])
+            grid = tf.tile(grid, [num_batch])
+            grid = tf.reshape(grid, [num_batch, 3, -1])
+
+            # Transform A x (x_t, y_t, 1)^T -> (x_s, y_s)
+            T_g = tf.matmul(params, grid)
+            x_s = tf.slice(T_g, [0, 0, 0], [-1, 1, -1])
+            y_s = tf.slice(T_g, [0, 1, 0], [-1, 1, -1])
+            x_s_flat = tf.reshape(x_s, [-1])
+            y_s_flat = tf.reshape(y_s, [-1])
+
+            outputs = interpolate(inputs, x_s_flat, y_s_flat, out_size)
+            outputs = tf.reshape(outputs, [num_batch, out_size[0], out_size[1], num_channels])
+            return outputs
+
+    with tf.variable_scope(name):
+        output = transform(inputs, params, out_size)
+        return output
+
+
+def build(implementation, inputs, params, data_format, args):
+    '''
+    return outputs in channels_last and gradients of their weighted sum w.r.t. inputs and params
+    '''
+
+    if implementation == "reference":
+        outputs = reference_spatial_transformer(inputs, params, args.out_size)
+    elif data_format == "channels_first":
+        outputs = ops.spatial_transformer(tf.transpose(inputs, [0, 3, 1, 2]), params, args.out_size, data_format)
+        outputs = tf.transpose(outputs, [0, 2, 3, 1])
+    else:
+        outputs = ops.spatial_transformer(inputs, params, args.out_size, data_format)
+
+    # 位置ごとに異なる重みをかけて勾配がすべての要素に依存するようにする
+    weights = tf.constant(np.random.RandomState(0).uniform(size=outputs.shape[1:]), dtype=tf.float32)
+    gradients = tf.gradients(tf.reduce_sum(outputs * weights), [inputs, params])
+
+    return outputs, gradients
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    np.random.seed(args.random_seed)
+    tf.set_random_seed(args.random_seed)
+
+    implementations = [("reference", "channels_last"), ("vectorized", "channels_last"), ("vectorized", "channels_first")]
+
+    with tf.Graph().as_default():
+
+        channels, height, width = args.input_shape
+        inputs = tf.constant(np.random.uniform(size=[args.batch_size, height, width, channels]), dtype=tf.float32)
+        # 恒等変換の周りでランダムに回転・拡大・平行移動し，画像の外を参照する点も含める
+        params = tf.constant(np.array([1.0, 0.0, 0.0, 0.0, 1.0, 0.0]) + np.random.normal(scale=0.3, size=[args.batch_size, 6]), dtype=tf.float32)
+
+        results = [(implementation, data_format, build(implementation, inputs, params, data_format, args)) for implementation, data_format in implementations]
+
+        with tf.Session() as session:
+
+            reference_outputs, reference_gradients = session.run(results[0][2])
+            for implementation, data_format, (outputs, gradients) in results[1:]:
+                outputs, gradients = session.run([outputs, gradients])
+                assert np.allclose(outputs, reference_outputs, atol=1e-5), data_format
+                for gradient, reference_gradient in zip(gradients, reference_gradients):
+                    assert np.allclose(gradient, reference_gradient, rtol=1e-3, atol=1e-3), data_format
+
+            print("[batch_size, C, H, W] = [{}, {}, {}, {}] => [{}, {}]".format(args.batch_size, channels, height, width, *args.out_size))
+            for implementation, data_format, (outputs, gradients) in results:
+                print("    {:<12} {:<16} forward: {:.3e} sec, forward + backward: {:.3e} sec".format(
+                    implementation,
+                    data_format,
+                    measure(session, outputs, args.number),
+                    measure(session, [outputs, gradients], args.number)
+                ))